@@ -0,0 +1,237 @@
+"""Local benchmarks for bot internals (no Telegram or internet needed).
+
+    python bench.py ydl [--runs 20] [--size-kb 512]
+    python bench.py router [--messages 100000]
+    python bench.py fragments [--fragments 32] [--size-kb 256] [--rate-kb 2048] [--runs 8]
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+
+# Local HTTP fixture
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves /video.mp4 (or /video.m3u8 with /fragN.ts) over keep-alive HTTP/1.1,
+    counts TCP connections and optionally throttles each connection like a CDN edge"""
+    protocol_version = 'HTTP/1.1'
+    payload = b''
+    fragments = 0
+    rate = 0  # bytes/s per connection, 0 = unthrottled
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def body(self):
+        if self.path.endswith('.m3u8'):
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+            for i in range(self.fragments):
+                lines += ["#EXTINF:2.0,", f"frag{i}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            return 'application/vnd.apple.mpegurl', "\n".join(lines).encode() + b"\n"
+        return 'video/mp4', self.payload
+
+    def do_HEAD(self):
+        content_type, body = self.body()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return body
+
+    def do_GET(self):
+        body = self.do_HEAD()
+        if not self.rate:
+            self.wfile.write(body)
+            return
+        chunk = max(1, int(self.rate / 20))
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            time.sleep(0.05)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Clients dropping keep-alive connections
+
+
+def start_fixture(size_kb, fragments=0, rate_kb=0):
+    """Start fixture server on a free port, return (server, url)"""
+    FixtureHandler.payload = os.urandom(size_kb * 1024)
+    FixtureHandler.fragments = fragments
+    FixtureHandler.rate = rate_kb * 1024
+    server = FixtureServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    name = 'video.m3u8' if fragments else 'video.mp4'
+    return server, f"http://127.0.0.1:{server.server_port}/{name}"
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name, timings, connections):
+    print(f"{name:<8} runs={len(timings)} mean={sum(timings) / len(timings) * 1000:.1f}ms "
+          f"p50={percentile(timings, 50) * 1000:.1f}ms p95={percentile(timings, 95) * 1000:.1f}ms "
+          f"connections={connections}")
+
+
+# yt-dlp: new YoutubeDL per request vs YdlPool
+def bench_ydl(args):
+    import yt_dlp
+    import bot
+
+    server, url = start_fixture(args.size_kb)
+    opts = {'format': 'best', 'quiet': True, 'no_warnings': True, 'noprogress': True}
+    scratch = tempfile.mkdtemp(prefix='bench-ydl-')
+    try:
+        timings = []
+        FixtureHandler.connections = 0
+        for i in range(args.runs):
+            path = os.path.join(scratch, f"fresh{i}.mp4")
+            started = time.perf_counter()
+            with yt_dlp.YoutubeDL(dict(opts, outtmpl=path)) as ydl:
+                ydl.download([url])
+            timings.append(time.perf_counter() - started)
+        report('fresh', timings, FixtureHandler.connections)
+
+        pool = bot.YdlPool({'bench': opts}, size=1)
+        pool.warm()
+        timings = []
+        FixtureHandler.connections = 0
+        for i in range(args.runs):
+            path = os.path.join(scratch, f"pooled{i}.mp4")
+            started = time.perf_counter()
+            with pool.checkout('bench', outtmpl=path) as ydl:
+                ydl.download([url])
+            timings.append(time.perf_counter() - started)
+        report('pooled', timings, FixtureHandler.connections)
+        pool.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+# URL router: route_message throughput on a mixed message corpus
+ROUTER_SAMPLES = (
+    "https://www.instagram.com/reel/C{id}/?igsh=MTc4MmM1YmI2Ng==",
+    "qarang instagram.com/p/B{id}/ zo'r",
+    "https://www.tiktok.com/@user.name/video/72{num}?is_from_webapp=1",
+    "https://vm.tiktok.com/ZM{id}/",
+    "https://youtu.be/{yt}?si=abc",
+    "https://m.youtube.com/watch?feature=share&v={yt}",
+    "https://www.youtube.com/shorts/{yt}",
+    "salom, bu oddiy xabar havolasiz",
+)
+
+
+def bench_router(args):
+    import bot
+
+    rng = random.Random(1)
+    alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-"
+    corpus = []
+    for i in range(args.messages):
+        template = ROUTER_SAMPLES[i % len(ROUTER_SAMPLES)]
+        corpus.append(template.format(
+            id=''.join(rng.choices(alphabet, k=10)), num=rng.randrange(10 ** 16), yt=''.join(rng.choices(alphabet, k=11))
+        ))
+    # Short links are resolved from the cache (no network); a miss is a single HEAD request
+    bot.short_link_cache = bot.TTLCache(len(corpus), 3600)
+    for text in corpus:
+        if "vm.tiktok.com" in text:
+            bot.short_link_cache.put(text.rstrip('/'), f"https://www.tiktok.com/@u/video/{rng.randrange(10 ** 18)}")
+
+    for name, resolve in (('route', False), ('resolve', True)):
+        timings = []
+        routed = 0
+        for text in corpus:
+            started = time.perf_counter()
+            routed += len(bot.route_message(text, resolve=resolve))
+            timings.append(time.perf_counter() - started)
+        total = sum(timings)
+        print(f"{name:<8} messages={len(corpus)} routed={routed} {len(corpus) / total:,.0f} msg/s "
+              f"p50={percentile(timings, 50) * 1e6:.1f}us p95={percentile(timings, 95) * 1e6:.1f}us")
+
+
+# Download engine: fragment concurrency against a per-connection throttled HLS fixture
+def bench_fragments(args):
+    import bot
+
+    server, url = start_fixture(args.size_kb, fragments=args.fragments, rate_kb=args.rate_kb)
+    opts = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'fixup': 'never'}
+    total = args.fragments * args.size_kb * 1024
+    scratch = tempfile.mkdtemp(prefix='bench-frag-')
+    try:
+        # Fixed settings
+        for fragments in (1, 2, 4, 8, 16):
+            pool = bot.YdlPool({'bench': dict(opts, concurrent_fragment_downloads=fragments)}, size=1)
+            path = os.path.join(scratch, f"fixed{fragments}.ts")
+            started = time.perf_counter()
+            with pool.checkout('bench', outtmpl=path) as ydl:
+                ydl.download([url])
+            elapsed = time.perf_counter() - started
+            pool.close()
+            print(f"fixed    fragments={fragments:<3} {elapsed:.2f}s {total / elapsed / 1024 / 1024:.1f} MB/s")
+
+        # Adaptive: DownloadEngine starts at 1 and climbs on measured throughput
+        engine = bot.DownloadEngine({'bench': {'fragments': 1, 'max_fragments': 16}},
+                                    bandwidth=args.budget_mbps * 1024 * 1024 / 8, max_connections=args.connections)
+        pool = bot.YdlPool({'bench': opts}, size=1, progress_hook=engine.progress_hook)
+        for i in range(args.runs):
+            path = os.path.join(scratch, f"adaptive{i}.ts")
+            fragments = engine.fragments_for('bench')
+            started = time.perf_counter()
+            with pool.checkout('bench', outtmpl=path) as ydl, engine.transfer(ydl, 'bench'):
+                ydl.download([url])
+            elapsed = time.perf_counter() - started
+            print(f"adaptive run={i} fragments={fragments:<3} {elapsed:.2f}s {total / elapsed / 1024 / 1024:.1f} MB/s")
+        pool.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ydl = commands.add_parser('ydl', help="YoutubeDL construction vs pooled reuse")
+    ydl.add_argument('--runs', type=int, default=20)
+    ydl.add_argument('--size-kb', type=int, default=512)
+    ydl.set_defaults(func=bench_ydl)
+
+    router = commands.add_parser('router', help="URL router throughput")
+    router.add_argument('--messages', type=int, default=100000)
+    router.set_defaults(func=bench_router)
+
+    fragments = commands.add_parser('fragments', help="Fixed vs adaptive concurrent fragment downloads")
+    fragments.add_argument('--fragments', type=int, default=32)
+    fragments.add_argument('--size-kb', type=int, default=256, help="fragment size")
+    fragments.add_argument('--rate-kb', type=int, default=2048, help="per-connection throttle (KB/s)")
+    fragments.add_argument('--runs', type=int, default=8, help="adaptive runs")
+    fragments.add_argument('--budget-mbps', type=float, default=0, help="global bandwidth budget (0 = unlimited)")
+    fragments.add_argument('--connections', type=int, default=24, help="global fragment connection budget")
+    fragments.set_defaults(func=bench_fragments)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
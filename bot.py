@@ -1,14 +1,40 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import telebot
-import instaloader
-import yt_dlp
+import requests
 import os
+import sys
 import json
+import re
+import urllib.parse
+import sqlite3
+import atexit
+import importlib
+import copy
 import uuid
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from collections import deque, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from telebot import types
 from dotenv import load_dotenv
-from moviepy import VideoFileClip
 import shutil
+import subprocess
+import html
+import csv
+import gzip
+import hmac
+import secrets
+import queue
+import signal
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Startup/import timing report (heavy modules are imported lazily, see lazy_import)
+startup_timings = {'imports': time.perf_counter() - STARTUP_STARTED}
+import_timings = {}
 
 # Load environment variables
 load_dotenv()
@@ -25,98 +51,1915 @@ try:
 except:
     ADMIN_ID = 0
 
-print(f"Bot started. Admin ID: {ADMIN_ID}")
+# Update delivery: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').strip().rstrip('/')  # Public base URL, e.g. https://app.up.railway.app
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '').strip()  # generated per run if unset
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+PORT = int(os.getenv('PORT', '8080'))
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '50'))  # keep-alive connections to the Bot API
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Prometheus /metrics (0 = off; = PORT in webhook mode needs METRICS_TOKEN)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '').strip()  # optional "Authorization: Bearer" for /metrics
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Custom Bot API server (local telegram-bot-api or a fake one for tests)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').strip().rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
 
-# User data storage (for MP3 extraction)
-user_data = {}
+# One keep-alive connection pool shared by all threads (telebot defaults to a session per thread)
+telebot.apihelper.session = requests.Session()
+telebot.apihelper.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=TELEGRAM_POOL_SIZE))
+telebot.apihelper.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=TELEGRAM_POOL_SIZE))
 
-# Users database file
-USERS_DB_FILE = "users_db.json"
+print(f"Bot started. Admin ID: {ADMIN_ID}, mode: {BOT_MODE}")
+
+# Webhook workers run handlers themselves (per-chat order), so no telebot thread pool there
+bot = telebot.TeleBot(BOT_TOKEN, threaded=BOT_MODE != 'webhook')
+
+# Audio extraction
+AUDIO_THREADS = int(os.getenv('AUDIO_THREADS', '1'))  # ffmpeg threads for MP3 encode
+MP3_BITRATE = 192  # kbps for every MP3 encode (yt-dlp and ffmpeg)
+AUDIO_TIMEOUT = int(os.getenv('AUDIO_TIMEOUT', '600'))
+AUDIO_COPY_CODECS = {'aac': 'm4a', 'mp3': 'mp3'}  # Sent as-is, no re-encode
+audio_stats = {'copy': [0, 0.0], 'encode': [0, 0.0]}  # mode -> [jobs, total seconds]
+
+# Video: stream copy into mp4 when codecs allow, transcode only as a last resort
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '1'))  # concurrent ffmpeg video encodes
+TRANSCODE_THREADS = int(os.getenv('TRANSCODE_THREADS', '2'))
+TRANSCODE_NICE = int(os.getenv('TRANSCODE_NICE', '10'))
+TRANSCODE_TIMEOUT = int(os.getenv('TRANSCODE_TIMEOUT', '1800'))
+MP4_VIDEO_CODECS = ('avc1', 'h264')  # Plays inline in every Telegram client
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3')
+transcode_slots = threading.BoundedSemaphore(max(1, TRANSCODE_WORKERS))
+video_stats = {'remux': [0, 0.0], 'transcode': [0, 0.0]}  # mode -> [jobs, total seconds]
+
+# Telegram upload limit (50MB for the cloud Bot API, up to 2000MB with a local Bot API server)
+TELEGRAM_UPLOAD_LIMIT = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', '50')) * 1024 * 1024
+
+# YouTube probe (extract_info) cache, shared by all users
+YT_INFO_CACHE_SIZE = int(os.getenv('YT_INFO_CACHE_SIZE', '256'))
+YT_INFO_CACHE_TTL = int(os.getenv('YT_INFO_CACHE_TTL', '1800'))  # Stream URLs expire after a few hours
+
+# Reusable yt-dlp instances (see YdlPool)
+YDL_POOL_SIZE = int(os.getenv('YDL_POOL_SIZE', '2'))  # idle instances kept per profile
+YDL_POOL_WARM = os.getenv('YDL_POOL_WARM', '0') == '1'  # build instances at startup (default: on first checkout)
+YDL_PROFILE_OPTS = json.loads(os.getenv('YDL_PROFILE_OPTS', '{}'))  # {"youtube": {"socket_timeout": 30}, ...}
+
+# Download engine (see DownloadEngine): per-platform yt-dlp transfer settings and a global budget
+DOWNLOAD_TUNING = {
+    'youtube': {'fragments': 4, 'max_fragments': 16, 'chunk_size': 10 * 1024 * 1024},
+    'tiktok': {'fragments': 2, 'max_fragments': 8, 'chunk_size': None},
+    'mp3': {'fragments': 4, 'max_fragments': 8, 'chunk_size': 10 * 1024 * 1024},
+}
+for _name, _opts in json.loads(os.getenv('DOWNLOAD_TUNING', '{}')).items():
+    DOWNLOAD_TUNING.setdefault(_name, {}).update(_opts)
+DOWNLOAD_BANDWIDTH_MBPS = float(os.getenv('DOWNLOAD_BANDWIDTH_MBPS', '0'))  # shared by all downloads, 0 = unlimited
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', '24'))  # fragment connections, all jobs
+
+# Instagram carousel items fetched in parallel per post
+INSTAGRAM_FETCH_WORKERS = int(os.getenv('INSTAGRAM_FETCH_WORKERS', '4'))
+INSTAGRAM_MAX_FETCHES = int(os.getenv('INSTAGRAM_MAX_FETCHES', '6'))  # CDN/GraphQL requests across all jobs
+INSTAGRAM_META_CACHE_SIZE = int(os.getenv('INSTAGRAM_META_CACHE_SIZE', '512'))
+INSTAGRAM_META_TTL = int(os.getenv('INSTAGRAM_META_TTL', '1800'))  # CDN URLs are signed and expire
+INSTAGRAM_USERNAME = os.getenv('INSTAGRAM_USERNAME', '').strip()
+INSTAGRAM_PASSWORD = os.getenv('INSTAGRAM_PASSWORD', '')
+INSTAGRAM_SESSION_FILE = os.getenv('INSTAGRAM_SESSION_FILE', '').strip() or None  # instaloader session file
+instagram_fetch_slots = threading.BoundedSemaphore(max(1, INSTAGRAM_MAX_FETCHES))
+
+# Share links (vm.tiktok.com, instagram.com/share) resolved to canonical URLs
+SHORT_LINK_CACHE_SIZE = int(os.getenv('SHORT_LINK_CACHE_SIZE', '4096'))
+SHORT_LINK_TTL = int(os.getenv('SHORT_LINK_TTL', str(24 * 3600)))
+SHORT_LINK_TIMEOUT = float(os.getenv('SHORT_LINK_TIMEOUT', '5'))
+SHORT_LINK_FAIL_TTL = int(os.getenv('SHORT_LINK_FAIL_TTL', '300'))  # don't retry a failing HEAD per message
+
+# Download workers (see JobScheduler)
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+
+# Durable job queue: requests are stored in SQLite and resumed after a restart
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '2'))  # a job that was running this many times is failed
+JOB_RESUME_MAX_AGE = int(os.getenv('JOB_RESUME_MAX_AGE', '3600'))  # older unfinished jobs are failed, not resumed
+JOB_RESUME_RATE = float(os.getenv('JOB_RESUME_RATE', '2'))  # resumed jobs per second
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', str(24 * 3600)))  # finished jobs kept for inspection
+
+# Worker processes: with N > 0 this process only receives updates and N processes run the jobs
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '0'))
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '0.5'))  # idle worker checks for new jobs
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv('WORKER_SHUTDOWN_TIMEOUT', '25'))  # running jobs may finish on SIGTERM
+WORKER_STATS_INTERVAL = int(os.getenv('WORKER_STATS_INTERVAL', '5'))  # workers publish admin counters to SQLite
+process_role = 'single'  # 'single', 'receiver' or 'worker'
+
+# User sessions (last link per user, for MP3/Description/quality buttons)
+SESSION_MAX = int(os.getenv('SESSION_MAX', '5000'))
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(24 * 3600)))
+SESSION_PERSIST = os.getenv('SESSION_PERSIST', '1') == '1'  # Keep buttons working across restarts
+
+# Admission control: per-user token bucket + global ceiling on queued/running jobs
+USER_RATE_PER_MIN = float(os.getenv('USER_RATE_PER_MIN', '6'))
+USER_BURST = int(os.getenv('USER_BURST', '3'))
+MAX_INFLIGHT_JOBS = int(os.getenv('MAX_INFLIGHT_JOBS', '40'))  # 0 = unlimited, tunable with /setlimit
+admission = {'max_inflight': MAX_INFLIGHT_JOBS}
+admission_stats = {'rate_limited': 0, 'busy': 0}
+
+# Broadcast (Telegram allows ~30 messages/second per bot)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_BATCH = 500
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between status message edits
+
+# Scratch space for downloads (one directory per job)
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT', 'scratch')
+SCRATCH_BUDGET = int(os.getenv('SCRATCH_BUDGET_MB', '2048')) * 1024 * 1024
+SCRATCH_MAX_AGE = int(os.getenv('SCRATCH_MAX_AGE', '3600'))  # seconds
+JANITOR_INTERVAL = int(os.getenv('JANITOR_INTERVAL', '60'))
+active_job_dirs = set()
+scratch_lock = threading.Lock()
+scratch_stats = {'bytes': 0, 'dirs': 0, 'evicted': 0}
+
+# Users database (SQLite, WAL mode)
+USERS_DB_FILE = "users_db.json"  # Legacy JSON database, migrated on startup
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', '5'))
+db_lock = threading.Lock()
+db_conn = None
+
+# Write-behind buffers (flushed every DB_FLUSH_INTERVAL seconds)
+pending_users = {}
+pending_downloads = {}
+pending_platform_downloads = {}
+pending_lock = threading.Lock()
+
+# Instaloader instance (created on first Instagram request, see get_loader)
+loader = None
+loader_lock = threading.Lock()
+
+# Telegram file_id cache (re-serve popular media without re-downloading)
+FILE_CACHE_FILE = "file_cache.json"  # Legacy JSON cache, migrated into SQLite
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', str(30 * 24 * 3600)))
+FILE_CACHE_MAX = int(os.getenv('FILE_CACHE_MAX', '20000'))
+file_cache = OrderedDict()  # key -> entry, oldest created first
+file_cache_lock = threading.Lock()
+file_cache_stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+
+# Bounded in-memory cache
+class TTLCache:
+    """Thread-safe LRU cache with max size and per-entry TTL"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return item[1] if item else None
+
+    def __len__(self):
+        return len(self.data)
+
+
+youtube_info_cache = TTLCache(YT_INFO_CACHE_SIZE, YT_INFO_CACHE_TTL)
+YOUTUBE_SELECTION_FIELDS = ('requested_formats', 'format_id', 'format', 'url', 'ext', 'protocol', 'manifest_url')
+instagram_post_cache = TTLCache(INSTAGRAM_META_CACHE_SIZE, INSTAGRAM_META_TTL)
+short_link_cache = TTLCache(SHORT_LINK_CACHE_SIZE, SHORT_LINK_TTL)
+short_link_failures = TTLCache(SHORT_LINK_CACHE_SIZE, SHORT_LINK_FAIL_TTL)
+
+
+# Rate limiting
+class TokenBucket:
+    """Token bucket rate limiter; pause() honours Telegram's retry_after"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if available. Returns seconds to wait (0 = acquired)"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for seconds (HTTP 429)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Stage metrics (queue, probe, download, postprocess, upload, cleanup per job)
+def sample_percentiles(values):
+    """(p50, p95) of samples, or None"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+class StageMetrics:
+    """Latency histograms per (platform, stage), job outcomes and bytes moved"""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, samples=500):
+        self.samples = samples
+        self.histograms = {}  # (platform, stage) -> [bucket counts, sum, count]
+        self.recent = {}  # stage -> deque of recent seconds (for p50/p95)
+        self.jobs = {}  # (platform, outcome) -> count
+        self.bytes = {}  # (platform, direction) -> count
+        self.lock = threading.Lock()
+
+    def observe(self, platform, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get((platform, stage))
+            if histogram is None:
+                histogram = self.histograms[(platform, stage)] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.recent.setdefault(stage, deque(maxlen=self.samples)).append(seconds)
+
+    def count_job(self, platform, outcome):
+        with self.lock:
+            self.jobs[(platform, outcome)] = self.jobs.get((platform, outcome), 0) + 1
+
+    def add_bytes(self, platform, direction, count):
+        with self.lock:
+            self.bytes[(platform, direction)] = self.bytes.get((platform, direction), 0) + count
+
+    def percentiles(self, stage):
+        """(p50, p95) of recent samples for stage, or None"""
+        with self.lock:
+            values = list(self.recent.get(stage, ()))
+        return sample_percentiles(values)
+
+    def recent_samples(self):
+        """{stage: recent seconds} (pooled across worker processes for the admin panel)"""
+        with self.lock:
+            return {stage: list(values) for stage, values in self.recent.items()}
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = ["# TYPE saverbot_stage_seconds histogram"]
+        with self.lock:
+            for (platform, stage), (counts, total, count) in sorted(self.histograms.items()):
+                labels = f'platform="{platform}",stage="{stage}"'
+                for bound, bucket in zip(self.BUCKETS, counts):
+                    lines.append(f'saverbot_stage_seconds_bucket{{{labels},le="{bound}"}} {bucket}')
+                lines.append(f'saverbot_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'saverbot_stage_seconds_sum{{{labels}}} {total:.6f}')
+                lines.append(f'saverbot_stage_seconds_count{{{labels}}} {count}')
+            lines.append("# TYPE saverbot_jobs_total counter")
+            for (platform, outcome), count in sorted(self.jobs.items()):
+                lines.append(f'saverbot_jobs_total{{platform="{platform}",outcome="{outcome}"}} {count}')
+            lines.append("# TYPE saverbot_bytes_total counter")
+            for (platform, direction), count in sorted(self.bytes.items()):
+                lines.append(f'saverbot_bytes_total{{platform="{platform}",direction="{direction}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()
+job_context = threading.local()  # .job = {'platform', 'outcome', 'stages'} while a scheduler job runs
+
+
+def current_job():
+    return getattr(job_context, 'job', None)
+
+
+@contextmanager
+def stage(name):
+    """Time a job stage; a finished upload marks the job as ok"""
+    started = time.monotonic()
+    ok = False
+    job = current_job()
+    if job and job.get('id'):
+        update_job(job['id'], stage=name)
+    try:
+        yield
+        ok = True
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe(job['platform'] if job else 'other', name, elapsed)
+        if job:
+            job['stages'][name] = job['stages'].get(name, 0) + elapsed
+            if ok and name == 'upload' and job['outcome'] == 'failed':
+                job['outcome'] = 'ok'
+
+
+def count_bytes(direction, count):
+    """Bytes downloaded from source / uploaded to Telegram by the current job"""
+    job = current_job()
+    metrics.add_bytes(job['platform'] if job else 'other', direction, count)
+
+
+def mark_outcome(outcome):
+    job = current_job()
+    if job:
+        job['outcome'] = outcome
+
+
+# User sessions
+class Session:
+    """Compact per-user session record"""
+    __slots__ = ('url', 'formats', 'file_path', 'folder_path', 'file_id', 'media_id', 'platform', 'caption', 'touched')
+
+    def __init__(self, touched=None, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        self.touched = touched or time.time()
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_json(self):
+        fields = {name: getattr(self, name) for name in self.__slots__ if name != 'touched'}
+        return json.dumps({name: value for name, value in fields.items() if value is not None}, ensure_ascii=False)
+
+
+class SessionStore:
+    """LRU + TTL session store; optionally mirrored to SQLite so buttons survive restarts.
+    Expired or replaced sessions delete their media folder. shared=True always reads
+    SQLite (sessions are written by worker processes and read by the receiver)."""
+
+    def __init__(self, max_entries, ttl, persist, shared=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist or shared
+        self.shared = shared
+        self.data = OrderedDict()  # user_id -> Session
+        self.lock = threading.Lock()
+
+    def _expired(self, session):
+        return time.time() - session.touched > self.ttl
+
+    def _drop_media(self, session, keep=None):
+        if session.folder_path and session.folder_path != keep:
+            release_job_dir(session.folder_path, remove=True)
+
+    def _load(self, user_id):
+        if not self.persist or db_conn is None:
+            return None
+        rows = db_query("SELECT data, touched FROM sessions WHERE user_id = ?", (user_id,))
+        if not rows:
+            return None
+        return Session(touched=rows[0]['touched'], **json.loads(rows[0]['data']))
+
+    def get(self, user_id, default=None):
+        with self.lock:
+            session = None if self.shared else self.data.get(user_id)
+            if session is not None:
+                self.data.move_to_end(user_id)
+        if session is None:
+            session = self._load(user_id)
+            if session is not None and not self.shared:
+                with self.lock:
+                    self.data[user_id] = session
+                    self._trim()
+        if session is None:
+            return default
+        if self._expired(session):
+            self.delete(user_id)
+            return default
+        # Access keeps the session (and its media) alive
+        session.touched = time.time()
+        if self.persist and db_conn is not None:
+            db_execute("UPDATE sessions SET touched = ? WHERE user_id = ?", (session.touched, user_id))
+        return session
+
+    def __getitem__(self, user_id):
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __setitem__(self, user_id, fields):
+        session = Session(**fields)
+        with self.lock:
+            old = self.data.pop(user_id, None)
+            self.data[user_id] = session
+            self._trim()
+        if old is None:
+            old = self._load(user_id)
+        if old is not None:
+            self._drop_media(old, keep=session.folder_path)
+        if self.persist and db_conn is not None:
+            db_execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, touched) VALUES (?, ?, ?)",
+                (user_id, session.to_json(), session.touched)
+            )
+
+    def delete(self, user_id):
+        with self.lock:
+            session = self.data.pop(user_id, None)
+        if session is None:
+            session = self._load(user_id)
+        if session is not None:
+            self._drop_media(session)
+        if self.persist and db_conn is not None:
+            db_execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def _trim(self):
+        """Enforce max entries (caller holds lock). Persisted sessions stay on disk until sweep"""
+        while len(self.data) > self.max_entries:
+            user_id, session = self.data.popitem(last=False)
+            if not self.persist:
+                self._drop_media(session)
+
+    def sweep(self):
+        """Remove expired and excess sessions from memory and disk"""
+        with self.lock:
+            expired = [user_id for user_id, session in self.data.items() if self._expired(session)]
+        for user_id in expired:
+            self.delete(user_id)
+        if self.persist and db_conn is not None:
+            cutoff = time.time() - self.ttl
+            for row in db_query("SELECT user_id FROM sessions WHERE touched < ?", (cutoff,)):
+                self.delete(row['user_id'])
+            # Least recently used beyond max_entries, with their media
+            for row in db_query("SELECT user_id FROM sessions ORDER BY touched DESC LIMIT -1 OFFSET ?",
+                                (self.max_entries,)):
+                self.delete(row['user_id'])
+
+    def media_folders(self):
+        """folder_path of every live session"""
+        with self.lock:
+            folders = {session.folder_path for session in self.data.values() if session.folder_path}
+        if self.persist and db_conn is not None:
+            for row in db_query("SELECT data FROM sessions WHERE touched >= ?", (time.time() - self.ttl,)):
+                folder = json.loads(row['data']).get('folder_path')
+                if folder:
+                    folders.add(folder)
+        return folders
+
+    def __len__(self):
+        if self.shared and db_conn is not None:
+            return db_query("SELECT COUNT(*) AS n FROM sessions")[0]['n']
+        return len(self.data)
+
+
+user_data = SessionStore(SESSION_MAX, SESSION_TTL, SESSION_PERSIST, shared=WORKER_PROCESSES > 0)
+
+
+# Lazy loading of heavy dependencies
+def lazy_import(name):
+    """Import module on first use and record how long it took"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    import_timings[name] = time.perf_counter() - started
+    print(f"📦 Imported {name} in {import_timings[name]:.2f}s")
+    return module
+
+
+def get_loader():
+    """Shared Instaloader instance, built on first use"""
+    global loader
+    if loader is None:
+        with loader_lock:
+            if loader is None:
+                instaloader = lazy_import('instaloader')
+                # Only used for Post metadata; media is fetched by URL, so no download options
+                loader = instaloader.Instaloader()
+                if INSTAGRAM_USERNAME:
+                    instagram_login(loader)
+    return loader
+
+
+def instagram_login(instance):
+    """Reuse saved session (or log in once and save it); anonymous on failure"""
+    try:
+        instance.load_session_from_file(INSTAGRAM_USERNAME, INSTAGRAM_SESSION_FILE)
+        print(f"🔑 Instagram session loaded for {INSTAGRAM_USERNAME}")
+        return
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Instagram session file error: {e}")
+    if not INSTAGRAM_PASSWORD:
+        print("⚠️ Instagram session file topilmadi, anonim rejimda")
+        return
+    try:
+        instance.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
+        instance.save_session_to_file(INSTAGRAM_SESSION_FILE)
+        print(f"🔑 Instagram logged in as {INSTAGRAM_USERNAME}")
+    except Exception as e:
+        print(f"⚠️ Instagram login failed, anonim rejimda: {e}")
+
+
+class YdlPool:
+    """Pre-built YoutubeDL instances per option profile.
+    An instance is used by one job at a time, so its extractors, HTTP
+    keep-alive connections and cookie jar survive between jobs."""
+    
+    def __init__(self, profiles, size, progress_hook=None):
+        self.profiles = profiles
+        self.size = size
+        self.progress_hook = progress_hook
+        self.idle = {name: [] for name in profiles}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+    
+    def _build(self, profile):
+        with self.lock:
+            self.created += 1
+        ydl = lazy_import('yt_dlp').YoutubeDL(copy.deepcopy(self.profiles[profile]))
+        if self.progress_hook:
+            ydl.add_progress_hook(self.progress_hook)
+        return ydl
+    
+    @contextmanager
+    def checkout(self, profile, format=None, outtmpl=None):
+        """Borrow an instance; format/outtmpl apply to this job only"""
+        with self.lock:
+            idle = self.idle[profile]
+            ydl = idle.pop() if idle else None
+            if ydl is not None:
+                self.reused += 1
+        if ydl is None:
+            ydl = self._build(profile)
+        
+        format = format or self.profiles[profile].get('format')
+        if format and ydl.params.get('format') != format:
+            ydl.params['format'] = format
+            ydl.format_selector = ydl.build_format_selector(format)
+        if outtmpl:
+            ydl.params['outtmpl'] = dict(ydl.params['outtmpl'], default=outtmpl)
+        
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            # Failed instances are dropped - their state is unknown
+            with self.lock:
+                if healthy and len(self.idle[profile]) < self.size:
+                    self.idle[profile].append(ydl)
+                    ydl = None
+            if ydl is not None:
+                ydl.close()
+    
+    def warm(self):
+        """Build one idle instance per profile (YDL_POOL_WARM=1: in background after startup)"""
+        for profile in self.profiles:
+            with self.checkout(profile):
+                pass
+    
+    def close(self):
+        with self.lock:
+            instances = [ydl for idle in self.idle.values() for ydl in idle]
+            for idle in self.idle.values():
+                idle.clear()
+        for ydl in instances:
+            ydl.close()
+    
+    def __len__(self):
+        return sum(len(idle) for idle in self.idle.values())
+
+
+class DownloadEngine:
+    """Transfer settings for pooled yt-dlp instances.
+    Fragment concurrency starts from the platform tuning and is hill-climbed per
+    host on measured throughput; bandwidth and fragment connections are a global
+    budget split between the downloads running right now."""
+    
+    MIN_SAMPLE = 1024 * 1024  # smaller files say nothing about throughput
+    
+    def __init__(self, tuning, bandwidth=0, max_connections=0):
+        self.tuning = tuning
+        self.bandwidth = bandwidth  # bytes/s, 0 = unlimited
+        self.max_connections = max_connections
+        self.hosts = {}  # host -> {'fragments', 'rates': {fragments: ewma B/s}, 'bytes', 'seconds'}
+        self.platform_hosts = {}
+        self.active = []  # ydl instances downloading now
+        self.local = threading.local()
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def host_of(url):
+        """CDN host with per-edge prefixes dropped (rr3---sn-x.googlevideo.com -> googlevideo.com)"""
+        host = urllib.parse.urlsplit(url or '').hostname or ''
+        if re.fullmatch(r'[\d.]+|[\da-f:]+', host):
+            return host
+        return '.'.join(host.split('.')[-2:])
+    
+    def _rebalance(self):
+        """Split the bandwidth budget between active downloads (caller holds lock).
+        yt-dlp limits each connection, so a download's share is divided by its fragments.
+        Fragment downloaders copy params when they start; plain HTTP picks changes up live."""
+        share = self.bandwidth / len(self.active) if self.bandwidth and self.active else None
+        for ydl in self.active:
+            ydl.params['ratelimit'] = int(share / ydl.params['concurrent_fragment_downloads']) if share else None
+    
+    def fragments_for(self, platform):
+        """Fragment concurrency for the next download of platform"""
+        tuning = self.tuning.get(platform, {})
+        with self.lock:
+            host = self.hosts.get(self.platform_hosts.get(platform))
+            fragments = host['fragments'] if host else tuning.get('fragments', 1)
+            if self.max_connections:
+                fragments = min(fragments, max(1, self.max_connections // (len(self.active) + 1)))
+        return max(1, fragments)
+    
+    @contextmanager
+    def transfer(self, ydl, platform):
+        """Apply platform/host settings to ydl for one download"""
+        tuning = self.tuning.get(platform, {})
+        ydl.params['concurrent_fragment_downloads'] = self.fragments_for(platform)
+        ydl.params['http_chunk_size'] = tuning.get('chunk_size')
+        self.local.platform = platform
+        with self.lock:
+            self.active.append(ydl)
+            self._rebalance()
+        try:
+            yield ydl
+        finally:
+            self.local.platform = None
+            with self.lock:
+                self.active.remove(ydl)
+                ydl.params['ratelimit'] = None
+                self._rebalance()
+            ydl.params['concurrent_fragment_downloads'] = 1
+            ydl.params['http_chunk_size'] = None
+    
+    def progress_hook(self, d):
+        """yt-dlp progress hook: one throughput sample per finished file"""
+        if d.get('status') != 'finished':
+            return
+        size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        elapsed = d.get('elapsed') or 0
+        url = (d.get('info_dict') or {}).get('url')
+        platform = getattr(self.local, 'platform', None)
+        if url and size >= self.MIN_SAMPLE and elapsed > 0:
+            self.record(self.host_of(url), platform, size, elapsed)
+    
+    def record(self, host, platform, size, elapsed):
+        """Update host throughput and pick fragment concurrency for its next download"""
+        rate = size / elapsed
+        tuning = self.tuning.get(platform, {})
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = {
+                    'fragments': max(1, tuning.get('fragments', 1)), 'rates': {}, 'bytes': 0, 'seconds': 0.0,
+                }
+            if platform:
+                self.platform_hosts[platform] = host
+            state['bytes'] += size
+            state['seconds'] += elapsed
+            
+            # Hill climb: double while it pays off, halve when fewer connections are as fast
+            current = state['fragments']
+            rates = state['rates']
+            rates[current] = rate if current not in rates else 0.7 * rates[current] + 0.3 * rate
+            up, down = current * 2, current // 2
+            if up <= tuning.get('max_fragments', current) and rates.get(up, float('inf')) > rates[current] * 1.1:
+                state['fragments'] = up
+            elif down >= 1 and rates.get(down, 0) >= rates[current] * 0.95:
+                state['fragments'] = down
+    
+    def stats(self):
+        """{host: (MB/s average, fragments)}"""
+        with self.lock:
+            return {
+                host: (state['bytes'] / state['seconds'] / (1024 * 1024), state['fragments'])
+                for host, state in self.hosts.items() if state['seconds']
+            }
+
+
+download_engine = DownloadEngine(DOWNLOAD_TUNING, DOWNLOAD_BANDWIDTH_MBPS * 1024 * 1024 / 8, DOWNLOAD_MAX_CONNECTIONS)
+
+
+def ydl_profiles():
+    """yt-dlp option profiles, overridable per profile with YDL_PROFILE_OPTS"""
+    profiles = {
+        'tiktok': {'format': 'best', 'quiet': True},
+        'probe': {'quiet': True, 'no_warnings': True},
+        'youtube': {'quiet': True, 'no_warnings': True, 'merge_output_format': 'mp4'},
+        'mp3': {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': str(MP3_BITRATE),
+            }],
+            'postprocessor_args': {'extractaudio+ffmpeg_o': ['-threads', str(AUDIO_THREADS)]},
+            'quiet': True
+        },
+    }
+    for name, opts in YDL_PROFILE_OPTS.items():
+        profiles.setdefault(name, {}).update(opts)
+    return profiles
 
-loader = instaloader.Instaloader(
-    download_comments=False,
-    download_geotags=False,
-    download_pictures=True,
-    download_video_thumbnails=False,
-    save_metadata=True,  # Need this for carousel detection
-    compress_json=False
-)
+
+ydl_pool = YdlPool(ydl_profiles(), YDL_POOL_SIZE, download_engine.progress_hook)
+atexit.register(ydl_pool.close)
+
+
+def startup_report():
+    """Startup phases and lazy import timings as text"""
+    lines = [f"{phase}: {seconds * 1000:.0f} ms" for phase, seconds in startup_timings.items()]
+    if import_timings:
+        lines.append("")
+        lines += [f"import {name}: {seconds * 1000:.0f} ms" for name, seconds in import_timings.items()]
+    else:
+        lines.append("(og'ir modullar hali yuklanmagan)")
+    return "\n".join(lines)
 
 
 # Database functions
-def load_users_db():
-    """Load users database"""
-    if os.path.exists(USERS_DB_FILE):
+def init_db():
+    """Open SQLite database and create tables"""
+    global db_conn
+    db_conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    db_conn.row_factory = sqlite3.Row
+    with db_lock:
+        db_conn.execute("PRAGMA journal_mode=WAL")
+        db_conn.execute("PRAGMA synchronous=NORMAL")
+        db_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                first_seen TEXT,
+                last_seen TEXT,
+                total_downloads INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'running',
+                cursor INTEGER NOT NULL DEFAULT -1,
+                total INTEGER NOT NULL DEFAULT 0,
+                success INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                created TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                touched REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_touched ON sessions(touched);
+            CREATE TABLE IF NOT EXISTS file_cache (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                platform TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                func TEXT NOT NULL,
+                args TEXT NOT NULL,
+                key TEXT,
+                stage TEXT NOT NULL DEFAULT 'queued',
+                status TEXT NOT NULL DEFAULT 'pending',
+                outcome TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker INTEGER,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, updated);
+            CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(key);
+            CREATE TABLE IF NOT EXISTS worker_stats (
+                worker INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS probe_cache (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS active_days (
+                day TEXT PRIMARY KEY,
+                users INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        columns = [row['name'] for row in db_conn.execute("PRAGMA table_info(users)")]
+        if 'blocked' not in columns:
+            db_conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        job_columns = [row['name'] for row in db_conn.execute("PRAGMA table_info(jobs)")]
+        if 'worker' not in job_columns:
+            db_conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+        if 'notice' not in job_columns:
+            db_conn.execute("ALTER TABLE jobs ADD COLUMN notice INTEGER")  # queue position message id
+        db_conn.commit()
+    migrate_json_users()
+    if not db_query("SELECT 1 FROM counters LIMIT 1"):
+        rebuild_aggregates()
+    threading.Thread(target=db_flush_loop, daemon=True).start()
+    atexit.register(flush_users_db)
+
+
+def migrate_json_users():
+    """One-shot import of legacy users_db.json into SQLite"""
+    if not os.path.exists(USERS_DB_FILE):
+        return
+    try:
+        with open(USERS_DB_FILE, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+    except:
+        print(f"⚠️ {USERS_DB_FILE} o'qilmadi, migratsiya o'tkazib yuborildi")
+        return
+    rows = []
+    for user_id_str, info in legacy.items():
         try:
-            with open(USERS_DB_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            rows.append((
+                int(info.get('user_id', user_id_str)),
+                info.get('username'),
+                info.get('first_name'),
+                info.get('first_seen'),
+                info.get('last_seen'),
+                int(info.get('total_downloads', 0) or 0)
+            ))
+        except (TypeError, ValueError):
+            pass
+    with db_lock:
+        db_conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, first_seen, last_seen, total_downloads) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        db_conn.commit()
+    os.replace(USERS_DB_FILE, USERS_DB_FILE + ".migrated")
+    print(f"✅ Migrated {len(rows)} users from {USERS_DB_FILE}")
+
+
+def rebuild_aggregates():
+    """One-time backfill of counters/active_days from the users table"""
+    with db_lock:
+        db_conn.executescript("""
+            DELETE FROM counters;
+            DELETE FROM active_days;
+            INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users;
+            INSERT INTO counters (name, value) SELECT 'downloads', COALESCE(SUM(total_downloads), 0) FROM users;
+            INSERT INTO counters (name, value) SELECT 'blocked', COUNT(*) FROM users WHERE blocked = 1;
+            INSERT INTO active_days (day, users)
+                SELECT substr(last_seen, 1, 10), COUNT(*) FROM users WHERE last_seen IS NOT NULL GROUP BY 1;
+        """)
+        db_conn.commit()
+    print("✅ Admin aggregates rebuilt")
+
+
+def add_counters(deltas):
+    """Apply counter deltas (caller holds db_lock)"""
+    db_conn.executemany(
+        "INSERT INTO counters (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        [(name, delta) for name, delta in deltas.items() if delta]
+    )
 
-def save_users_db(db):
-    """Save users database"""
-    with open(USERS_DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
 
 def register_user(user):
-    """Register or update user"""
-    db = load_users_db()
-    user_id_str = str(user.id)
-    
-    if user_id_str not in db:
-        db[user_id_str] = {
-            'user_id': user.id,
-            'username': user.username,
-            'first_name': user.first_name,
-            'first_seen': datetime.now().isoformat(),
-            'last_seen': datetime.now().isoformat(),
-            'total_downloads': 0
-        }
-    else:
-        db[user_id_str]['last_seen'] = datetime.now().isoformat()
-    
-    save_users_db(db)
+    """Register or update user (buffered, written by flush_users_db)"""
+    now = datetime.now().isoformat()
+    with pending_lock:
+        pending_users[user.id] = (user.id, user.username, user.first_name, now, now)
+
+
+def increment_download_count(user_id, platform=None):
+    """Increment user download count (buffered)"""
+    with pending_lock:
+        pending_downloads[user_id] = pending_downloads.get(user_id, 0) + 1
+        if platform:
+            pending_platform_downloads[platform] = pending_platform_downloads.get(platform, 0) + 1
+
+
+def flush_users_db():
+    """Write buffered user updates to SQLite in one transaction.
+    Admin aggregates (counters, active_days) are updated from the same deltas."""
+    with pending_lock:
+        users = list(pending_users.values())
+        downloads = list(pending_downloads.items())
+        platform_downloads = dict(pending_platform_downloads)
+        pending_users.clear()
+        pending_downloads.clear()
+        pending_platform_downloads.clear()
+    if not users and not downloads or db_conn is None:
+        return
+    try:
+        # Connection as context manager: one transaction, rolled back on error
+        with db_lock, db_conn:
+            # Previous last_seen/blocked of flushed users (new users have no row)
+            previous = {}
+            user_ids = [user[0] for user in users]
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                for row in db_conn.execute(
+                    f"SELECT user_id, last_seen, blocked FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+                ):
+                    previous[row['user_id']] = row
+            
+            # active_days.users = number of users whose latest active day is day
+            day_deltas = {}
+            counter_deltas = {'users': 0, 'blocked': 0, 'downloads': sum(count for _, count in downloads)}
+            for platform, count in platform_downloads.items():
+                counter_deltas[f"downloads:{platform}"] = count
+            for user_id, _, _, _, last_seen in users:
+                day = last_seen[:10]
+                old = previous.get(user_id)
+                if old is None:
+                    counter_deltas['users'] += 1
+                else:
+                    counter_deltas['blocked'] -= old['blocked']
+                    old_day = (old['last_seen'] or '')[:10]
+                    if old_day == day:
+                        continue
+                    if old_day:
+                        day_deltas[old_day] = day_deltas.get(old_day, 0) - 1
+                day_deltas[day] = day_deltas.get(day, 0) + 1
+            
+            db_conn.executemany(
+                "INSERT INTO users (user_id, username, first_name, first_seen, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, "
+                "first_name=excluded.first_name, last_seen=excluded.last_seen, blocked=0",
+                users
+            )
+            db_conn.executemany(
+                "UPDATE users SET total_downloads = total_downloads + ? WHERE user_id = ?",
+                [(count, user_id) for user_id, count in downloads]
+            )
+            add_counters(counter_deltas)
+            db_conn.executemany(
+                "INSERT INTO active_days (day, users) VALUES (?, ?) "
+                "ON CONFLICT(day) DO UPDATE SET users = users + excluded.users",
+                [(day, delta) for day, delta in day_deltas.items() if delta]
+            )
+    except Exception:
+        # Put the batch back so the next flush retries it (e.g. 'database is locked')
+        with pending_lock:
+            for user in users:
+                pending_users.setdefault(user[0], user)
+            for user_id, count in downloads:
+                pending_downloads[user_id] = pending_downloads.get(user_id, 0) + count
+            for platform, count in platform_downloads.items():
+                pending_platform_downloads[platform] = pending_platform_downloads.get(platform, 0) + count
+        raise
+
+
+def db_flush_loop():
+    """Background write-behind flusher"""
+    while True:
+        time.sleep(DB_FLUSH_INTERVAL)
+        try:
+            flush_users_db()
+        except Exception as e:
+            print(f"❌ DB flush error: {e}")
+
+
+def db_query(sql, params=()):
+    """Run a read query and return all rows"""
+    with db_lock:
+        return db_conn.execute(sql, params).fetchall()
+
+
+def db_execute(sql, params=()):
+    """Run a write statement and commit"""
+    with db_lock:
+        cursor = db_conn.execute(sql, params)
+        db_conn.commit()
+        return cursor
+
+
+def get_setting(key, default=None):
+    """Admin-tuned setting stored in SQLite"""
+    rows = db_query("SELECT value FROM settings WHERE key = ?", (key,))
+    return rows[0]['value'] if rows else default
+
+
+def set_setting(key, value):
+    db_execute("INSERT INTO settings (key, value) VALUES (?, ?) "
+               "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, str(value)))
 
-def increment_download_count(user_id):
-    """Increment user download count"""
-    db = load_users_db()
-    user_id_str = str(user_id)
-    if user_id_str in db:
-        db[user_id_str]['total_downloads'] = db[user_id_str].get('total_downloads', 0) + 1
-        save_users_db(db)
 
 def is_admin(user_id):
     """Check if user is admin"""
     return ADMIN_ID != 0 and user_id == ADMIN_ID
 
-def cleanup_all_folders():
-    """Cleanup all temporary Instagram folders"""
+# Scratch directories (one per job) and janitor
+def new_job_dir(prefix):
+    """Create an isolated scratch directory for one job"""
+    path = os.path.join(SCRATCH_ROOT, f"{prefix}-{uuid.uuid4().hex[:12]}")
+    os.makedirs(path)
+    with scratch_lock:
+        active_job_dirs.add(path)
+    return path
+
+
+def release_job_dir(path, remove=False):
+    """Mark job directory as idle (janitor may evict it) or remove it now"""
+    if not path:
+        return
+    with scratch_lock:
+        active_job_dirs.discard(path)
+    if remove:
+        with stage('cleanup'):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def touch_job_dir(path):
+    """Mark job directory as recently used (LRU)"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def dir_size(path):
+    """Total size of files in a directory tree"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def scratch_usage():
+    """List (mtime, size, path) of scratch job directories"""
+    entries = []
     try:
-        for item in os.listdir('.'):
-            if os.path.isdir(item) and len(item) == 11:  # Instagram shortcode length
+        with os.scandir(SCRATCH_ROOT) as it:
+            for entry in it:
+                if entry.is_dir():
+                    try:
+                        entries.append((entry.stat().st_mtime, dir_size(entry.path), entry.path))
+                    except OSError:
+                        pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def run_janitor():
+    """Evict expired scratch dirs, then LRU until under disk budget.
+    Dirs of live sessions (MP3 button) outlive SCRATCH_MAX_AGE and only go under budget pressure"""
+    now = time.time()
+    entries = sorted(scratch_usage())  # Oldest first
+    with scratch_lock:
+        active = set(active_job_dirs)
+    in_session = user_data.media_folders()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if path in active:
+            continue
+        expired = now - mtime > SCRATCH_MAX_AGE and path not in in_session
+        if expired or total > SCRATCH_BUDGET:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    scratch_stats['bytes'] = total
+    scratch_stats['dirs'] = len(entries) - removed
+    scratch_stats['evicted'] += removed
+    if removed:
+        print(f"🧹 Janitor removed {removed} scratch dirs ({total / (1024 * 1024):.1f}MB left)")
+
+
+def janitor_loop():
+    """Background janitor thread"""
+    while True:
+        try:
+            user_data.sweep()
+            run_janitor()
+            prune_jobs()
+        except Exception as e:
+            print(f"❌ Janitor error: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+
+# URL routing
+MediaRoute = namedtuple('MediaRoute', 'platform media_id url')
+
+# One alternation, compiled once (first match wins, so share links go first). Groups holding
+# the ID are named after the platform, '*_short' groups are redirects resolved with a HEAD request.
+URL_ROUTES = (
+    r'(?P<instagram_short>(?:www\.)?instagram\.com/share/(?:p/|reels?/)?[\w-]+)',
+    r'(?:www\.)?(?:instagram\.com|instagr\.am)/(?:[\w.]+/)?(?:p|reels?|tv)/(?P<instagram>[\w-]+)',
+    r'(?:www\.|m\.)?tiktok\.com/(?:@[\w.-]*/(?:video|photo)/|v/|embed/(?:v2/)?)(?P<tiktok>\d+)',
+    r'(?P<tiktok_short>(?:(?:vm|vt)\.tiktok\.com|(?:www\.)?tiktok\.com/t)/[\w-]+)',
+    r'(?:(?:www\.|m\.|music\.)?youtube\.com/(?:watch\?(?:[^\s#]*?&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)'
+    r'(?P<youtube>[\w-]{11})(?![\w-])',
+)
+URL_PATTERN = re.compile(r'(?:https?://)?(?<![\w.-])(?:' + '|'.join(URL_ROUTES) + ')', re.IGNORECASE)
+CANONICAL_URLS = {
+    'instagram': "https://www.instagram.com/p/{}/",
+    'youtube': "https://www.youtube.com/watch?v={}",
+}
+MAX_LINKS_PER_MESSAGE = 3
+
+
+def resolve_short_link(url):
+    """Final URL of a share link (cached HEAD request), or None"""
+    resolved = short_link_cache.get(url)
+    if resolved is None:
+        if short_link_failures.get(url):
+            return None
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=SHORT_LINK_TIMEOUT,
+                                     headers={'User-Agent': 'Mozilla/5.0'})
+            resolved = response.url
+        except requests.RequestException as e:
+            print(f"⚠️ Short link {url}: {e}")
+            short_link_failures.put(url, True)
+            return None
+        short_link_cache.put(url, resolved)
+    return resolved
+
+
+def route_match(match, resolve=True):
+    """MediaRoute for one URL_PATTERN match"""
+    group = match.lastgroup
+    if group.endswith('_short'):
+        platform = group[:-len('_short')]
+        link = "https://" + match.group(group)
+        resolved = resolve_short_link(link) if resolve else None
+        route = route_url(resolved, resolve=False) if resolved else None
+        if route and route.platform == platform:
+            return route
+        # Unresolved - key by the short link itself, downloaders follow redirects
+        return MediaRoute(platform, f"{platform}:{match.group(group)}", link)
+    media = match.group(group)
+    if group in CANONICAL_URLS:
+        url = CANONICAL_URLS[group].format(media)
+    else:
+        url = "https://" + re.sub(r'^https?://', '', match.group(0), flags=re.IGNORECASE)
+    return MediaRoute(group, f"{group}:{media}", url)
+
+
+def route_message(text, resolve=True):
+    """All supported media links in a message, deduplicated by canonical ID"""
+    routes, seen = [], set()
+    for match in URL_PATTERN.finditer(text or ''):
+        route = route_match(match, resolve)
+        if route.media_id not in seen:
+            seen.add(route.media_id)
+            routes.append(route)
+    return routes
+
+
+def route_url(url, resolve=True):
+    """First MediaRoute in url, or None"""
+    match = URL_PATTERN.search(url or '')
+    return route_match(match, resolve) if match else None
+
+
+def media_id(url):
+    """Canonical media ID used as cache key (platform:id)"""
+    route = route_url(url)
+    return route.media_id if route else url.strip()
+
+
+# Telegram file_id cache
+def load_file_cache():
+    """Load file_id cache from SQLite (imports legacy file_cache.json once)"""
+    if os.path.exists(FILE_CACHE_FILE):
+        try:
+            with open(FILE_CACHE_FILE, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            with db_lock:
+                db_conn.executemany(
+                    "INSERT OR IGNORE INTO file_cache (key, data, created) VALUES (?, ?, ?)",
+                    [(k, json.dumps(v, ensure_ascii=False), v.get('created', 0)) for k, v in legacy.items()]
+                )
+                db_conn.commit()
+            os.replace(FILE_CACHE_FILE, FILE_CACHE_FILE + ".migrated")
+        except Exception as e:
+            print(f"⚠️ file_cache migration error: {e}")
+    min_created = time.time() - FILE_CACHE_TTL
+    for row in db_query("SELECT key, data FROM file_cache WHERE created >= ? ORDER BY created", (min_created,)):
+        file_cache[row['key']] = json.loads(row['data'])
+
+
+def save_file_cache(key):
+    """Persist one cache entry, or delete it if gone (caller holds file_cache_lock)"""
+    with db_lock:
+        entry = file_cache.get(key)
+        if entry is None:
+            db_conn.execute("DELETE FROM file_cache WHERE key = ?", (key,))
+        else:
+            db_conn.execute(
+                "INSERT OR REPLACE INTO file_cache (key, data, created) VALUES (?, ?, ?)",
+                (key, json.dumps(entry, ensure_ascii=False), entry['created'])
+            )
+        db_conn.commit()
+
+
+def cache_key(media, quality='default'):
+    """Build cache key from canonical media ID and quality/format"""
+    return f"{media}|{quality}"
+
+
+def cache_lookup(key):
+    """Live entry or None, drops expired (caller holds file_cache_lock)"""
+    entry = file_cache.get(key)
+    if entry is None and WORKER_PROCESSES > 0:
+        # Another worker process may have uploaded it
+        rows = db_query("SELECT data FROM file_cache WHERE key = ?", (key,))
+        if rows:
+            entry = file_cache[key] = json.loads(rows[0]['data'])
+    if entry and time.time() - entry.get('created', 0) > FILE_CACHE_TTL:
+        del file_cache[key]
+        save_file_cache(key)
+        entry = None
+    return entry
+
+
+def cache_get(key):
+    """Get cached entry or None (counts hit/miss, drops expired)"""
+    with file_cache_lock:
+        entry = cache_lookup(key)
+        if entry:
+            file_cache_stats['hits'] += 1
+        else:
+            file_cache_stats['misses'] += 1
+    return entry
+
+
+def cache_valid(key):
+    """True if key has a live entry (routing check, not counted as hit/miss)"""
+    with file_cache_lock:
+        return cache_lookup(key) is not None
+
+
+def cache_put(key, items, caption=None, group=False):
+    """Store sent file_ids under key (group=True: replay as media group)"""
+    items = [item for item in items if item and item.get('file_id')]
+    if not items:
+        return
+    with file_cache_lock:
+        file_cache.pop(key, None)  # Re-put moves the key to the newest end
+        file_cache[key] = {'items': items, 'caption': caption, 'created': time.time()}
+        if group:
+            file_cache[key]['group'] = True
+        save_file_cache(key)
+        # Drop oldest entries
+        evicted = [file_cache.popitem(last=False)[0] for _ in range(len(file_cache) - FILE_CACHE_MAX)]
+        if evicted:
+            db_execute(f"DELETE FROM file_cache WHERE key IN ({','.join('?' * len(evicted))})", evicted)
+
+
+def cache_invalidate(key):
+    """Remove stale entry (Telegram rejected file_id)"""
+    with file_cache_lock:
+        if file_cache.pop(key, None) is not None:
+            file_cache_stats['invalidated'] += 1
+            save_file_cache(key)
+
+
+def sent_item(sent_message, caption=None):
+    """Extract cache item {type, file_id} from a sent message"""
+    if sent_message is None:
+        return None
+    if sent_message.video:
+        item = {'type': 'video', 'file_id': sent_message.video.file_id}
+    elif sent_message.animation:
+        item = {'type': 'animation', 'file_id': sent_message.animation.file_id}
+    elif sent_message.audio:
+        item = {'type': 'audio', 'file_id': sent_message.audio.file_id}
+    elif sent_message.document:
+        item = {'type': 'document', 'file_id': sent_message.document.file_id}
+    elif sent_message.photo:
+        item = {'type': 'photo', 'file_id': sent_message.photo[-1].file_id}
+    else:
+        return None
+    if caption:
+        item['caption'] = caption
+    return item
+
+
+def send_by_file_id(chat_id, item, reply_markup=None):
+    """Send one cached item by file_id"""
+    senders = {
+        'video': bot.send_video,
+        'animation': bot.send_animation,
+        'audio': bot.send_audio,
+        'document': bot.send_document,
+        'photo': bot.send_photo,
+    }
+    return senders[item['type']](chat_id, item['file_id'], caption=item.get('caption'), reply_markup=reply_markup)
+
+
+def send_cached(key, chat_id, reply_markup=None, entry=None):
+    """Re-send cached media by file_id. Returns entry on hit, None on miss"""
+    if entry is None:
+        entry = cache_get(key)
+    if not entry:
+        return None
+    try:
+        with stage('upload'):
+            if entry.get('group'):
+                send_media_groups(chat_id, [(item['type'], item['file_id'], item.get('caption')) for item in entry['items']])
+                if reply_markup:
+                    bot.send_message(chat_id, media_group_text(entry['items']), reply_markup=reply_markup)
+            else:
+                for i, item in enumerate(entry['items']):
+                    send_by_file_id(chat_id, item, reply_markup=reply_markup if i == 0 else None)
+        mark_outcome('cached')
+        return entry
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code == 400:
+            # Stale or foreign file_id - download again
+            print(f"♻️ Stale file_id for {key}: {e.description}")
+            cache_invalidate(key)
+            return None
+        raise
+
+
+def send_media_groups(chat_id, media):
+    """Send [(kind, source, caption)] as albums of up to 10 items; source is a file path, bytes or file_id.
+    Returns list of sent cache items in order"""
+    sent_items = []
+    # Albums need 2-10 items: split evenly (11 -> 6 + 5, not 10 + 1)
+    batch_count = -(-len(media) // 10)
+    batch_size = -(-len(media) // batch_count) if media else 10
+    for start in range(0, len(media), batch_size):
+        batch = media[start:start + batch_size]
+        opened = []
+        try:
+            sources = []
+            for kind, source, caption in batch:
+                if isinstance(source, str) and os.path.exists(source):
+                    source = open(source, 'rb')
+                    opened.append(source)
+                sources.append(source)
+            if len(batch) == 1:
+                kind, _, caption = batch[0]
+                sender = bot.send_video if kind == 'video' else bot.send_photo
+                sent_items.append(sent_item(sender(chat_id, sources[0], caption=caption), caption))
+                continue
+            group = []
+            for (kind, _, caption), source in zip(batch, sources):
+                input_class = types.InputMediaVideo if kind == 'video' else types.InputMediaPhoto
+                group.append(input_class(source, caption=caption))
+            for sent, (kind, source, caption) in zip(bot.send_media_group(chat_id, group), batch):
+                sent_items.append(sent_item(sent, caption))
+        finally:
+            for f in opened:
+                f.close()
+    return sent_items
+
+
+def media_group_text(items):
+    """Text for the message carrying buttons under an album"""
+    videos = sum(1 for item in items if item['type'] == 'video')
+    photos = len(items) - videos
+    parts = []
+    if photos:
+        parts.append(f"📸 {photos} ta rasm")
+    if videos:
+        parts.append(f"🎬 {videos} ta video")
+    return "Instagram: " + ", ".join(parts)
+
+
+def fetch_telegram_file(file_id, path):
+    """Download a file already on Telegram servers (<=20MB)"""
+    file_info = bot.get_file(file_id)
+    with open(path, 'wb') as f:
+        f.write(bot.download_file(file_info.file_path))
+    return path
+
+
+# Download job scheduler
+class JobScheduler:
+    """Worker pool with per-platform concurrency caps and round-robin fairness across users"""
+
+    def __init__(self, workers, platform_limits):
+        self.workers = workers
+        self.platform_limits = platform_limits
+        self.running = {platform: 0 for platform in platform_limits}
+        self.queues = {}  # user_id -> deque of pending jobs
+        self.order = deque()  # round-robin order of users with pending jobs
+        self.cond = threading.Condition()
+        self.started = False
+
+    def start(self):
+        """Start worker threads"""
+        if self.started:
+            return
+        self.started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, user_id, platform, func, *args, on_start=None, job_id=None):
+        """Queue a job. Returns number of jobs that will run before it (0 = starts now)"""
+        job = {'user_id': user_id, 'platform': platform, 'func': func, 'args': args, 'on_start': on_start,
+               'submitted': time.monotonic(), 'job_id': job_id}
+        with self.cond:
+            if user_id not in self.queues:
+                self.queues[user_id] = deque()
+                self.order.append(user_id)
+            self.queues[user_id].append(job)
+            position = self._position(user_id, len(self.queues[user_id]) - 1)
+            self.cond.notify()
+        return position
+
+    def _position(self, user_id, index):
+        """Estimate jobs ahead of user's job #index under round-robin"""
+        ahead = index
+        for other_id, queue in self.queues.items():
+            if other_id != user_id:
+                ahead += min(len(queue), index + 1)
+        platform = self.queues[user_id][index]['platform']
+        busy = sum(self.running.values()) >= self.workers
+        capped = self.running.get(platform, 0) >= self._limit(platform)
+        if ahead == 0 and (busy or capped):
+            ahead = 1
+        return ahead
+
+    def _limit(self, platform):
+        return self.platform_limits.get(platform, self.workers)
+
+    def _next_job(self):
+        """Pick next runnable job, rotating over users (caller holds cond)"""
+        for _ in range(len(self.order)):
+            user_id = self.order[0]
+            self.order.rotate(-1)
+            queue = self.queues[user_id]
+            for job in queue:
+                if self.running.get(job['platform'], 0) < self._limit(job['platform']):
+                    queue.remove(job)
+                    if not queue:
+                        del self.queues[user_id]
+                        self.order.remove(user_id)
+                    return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self._next_job()
+                self.running[job['platform']] = self.running.get(job['platform'], 0) + 1
+            started = time.monotonic()
+            metrics.observe(job['platform'], 'queue', started - job['submitted'])
+            context = job_context.job = {'platform': job['platform'], 'outcome': 'failed', 'stages': {},
+                                         'id': job['job_id']}
+            try:
+                start_job(job['job_id'])
+                if job['on_start']:
+                    job['on_start']()
+                job['func'](*job['args'])
+            except Exception as e:
+                context['outcome'] = 'error'
+                print(f"❌ Job error ({job['platform']}): {e}")
+            finally:
+                job_context.job = None
+                if context['outcome'] != 'requeued':
+                    finish_job(job['job_id'], context['outcome'])
+                metrics.count_job(job['platform'], context['outcome'])
+                timings = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in context['stages'].items())
+                print(f"⏱ {job['platform']} job {context['outcome']} in {time.monotonic() - started:.2f}s"
+                      f" (queue {started - job['submitted']:.2f}s{', ' + timings if timings else ''})")
+                with self.cond:
+                    self.running[job['platform']] -= 1
+                    self.cond.notify_all()
+
+    def stats(self):
+        """Snapshot of queued and running jobs"""
+        with self.cond:
+            return {
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                'running': dict(self.running)
+            }
+
+
+scheduler = JobScheduler(
+    DOWNLOAD_WORKERS,
+    {
+        'instagram': int(os.getenv('INSTAGRAM_CONCURRENCY', '2')),
+        'tiktok': int(os.getenv('TIKTOK_CONCURRENCY', '3')),
+        'youtube': int(os.getenv('YOUTUBE_CONCURRENCY', '2')),
+        'probe': int(os.getenv('PROBE_CONCURRENCY', '3')),
+        'audio': int(os.getenv('AUDIO_CONCURRENCY', '1')),
+        'cached': DOWNLOAD_WORKERS,  # file_id re-sends, no download
+    }
+)
+
+
+# Durable job queue
+DURABLE_FUNCS = ('download_instagram', 'download_tiktok', 'show_youtube_qualities', 'download_youtube',
+                 'download_youtube_mp3', 'extract_audio')
+
+
+def encode_job_args(args):
+    """Job args as JSON; telebot messages are stored as their raw Bot API JSON"""
+    encoded = []
+    for arg in args:
+        if isinstance(arg, types.Message):
+            encoded.append({'__message__': arg.json if isinstance(arg.json, dict) else json.loads(arg.json)})
+        else:
+            encoded.append(arg)
+    return json.dumps(encoded, ensure_ascii=False)
+
+
+def decode_job_args(data):
+    return [
+        types.Message.de_json(arg['__message__']) if isinstance(arg, dict) and '__message__' in arg else arg
+        for arg in json.loads(data)
+    ]
+
+
+def record_job(user_id, platform, kind, message, func, args, key=None):
+    """Store a request before it is queued. Returns job id, or None if it can't be resumed"""
+    if db_conn is None or func.__name__ not in DURABLE_FUNCS:
+        return None
+    try:
+        encoded = encode_job_args(args)
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Job not durable ({func.__name__}): {e}")
+        return None
+    now = time.time()
+    cursor = db_execute(
+        "INSERT INTO jobs (user_id, chat_id, platform, kind, func, args, key, created, updated) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, message.chat.id, platform, kind, func.__name__, encoded, key, now, now)
+    )
+    return cursor.lastrowid
+
+
+def update_job(job_id, **fields):
+    if job_id is None or db_conn is None:
+        return
+    fields['updated'] = time.time()
+    db_execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?", (*fields.values(), job_id))
+
+
+def start_job(job_id):
+    """Job picked by a worker - counts as an attempt (a job that keeps crashing the bot is not resumed forever)"""
+    if job_id is None or db_conn is None:
+        return
+    db_execute("UPDATE jobs SET status = 'running', stage = 'started', attempts = attempts + 1, updated = ? "
+               "WHERE id = ?", (time.time(), job_id))
+
+
+def finish_job(job_id, outcome):
+    """'error' = unexpected exception, anything else reached the user (file or error message)"""
+    update_job(job_id, status='failed' if outcome == 'error' else 'done', outcome=outcome)
+
+
+def prune_jobs():
+    if db_conn is None:
+        return
+    db_execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (time.time() - JOB_RETENTION,))
+    db_execute("DELETE FROM probe_cache WHERE created < ?", (time.time() - YT_INFO_CACHE_TTL,))
+
+
+def resume_jobs():
+    """Re-queue jobs interrupted by a restart (in the background, at JOB_RESUME_RATE)"""
+    rows = db_query("SELECT * FROM jobs WHERE status IN ('pending', 'claimed', 'running') ORDER BY id")
+    if not rows:
+        return
+    print(f"♻️ Unfinished jobs: {len(rows)}")
+    if process_role == 'receiver':
+        # Worker processes claim pending rows as they have free slots
+        for row in rows:
+            if job_resumable(row):
+                update_job(row['id'], status='pending', worker=None)
+            else:
+                fail_interrupted_job(row)
+        return
+    threading.Thread(target=drain_jobs, args=(rows,), name='job-resume', daemon=True).start()
+
+
+def job_resumable(row):
+    return row['attempts'] < JOB_MAX_ATTEMPTS and time.time() - row['created'] <= JOB_RESUME_MAX_AGE
+
+
+def dispatch_job_row(row):
+    """Queue a stored job in this process. Returns False if it can't be decoded"""
+    try:
+        func = globals()[row['func']]
+        args = decode_job_args(row['args'])
+        message = next(arg for arg in args if isinstance(arg, types.Message))
+    except Exception as e:
+        print(f"⚠️ Job {row['id']} can't be resumed: {e}")
+        fail_interrupted_job(row)
+        return False
+    if row['kind'] == 'download':
+        submit_download(row['user_id'], row['platform'], message, row['key'], func, *args, job_id=row['id'])
+    else:
+        submit_job(row['user_id'], row['platform'], message, func, *args, job_id=row['id'])
+    return True
+
+
+def drain_jobs(rows):
+    """Resume or fail unfinished jobs without flooding the scheduler"""
+    bucket = TokenBucket(JOB_RESUME_RATE)
+    resumed = failed = 0
+    for row in rows:
+        if not job_resumable(row):
+            fail_interrupted_job(row)
+            failed += 1
+            continue
+        
+        # Leave room for new requests: one worker's worth of backlog at a time
+        while scheduler.stats()['queued'] >= scheduler.workers:
+            time.sleep(1)
+        bucket.acquire()
+        update_job(row['id'], status='pending', stage='queued')
+        notify_resumed(row)
+        if dispatch_job_row(row):
+            resumed += 1
+        else:
+            failed += 1
+    print(f"♻️ Jobs resumed: {resumed}, failed: {failed}")
+
+
+def notify_resumed(row):
+    try:
+        bot.send_message(row['chat_id'], "♻️ Bot qayta ishga tushdi, so'rovingiz davom ettirilmoqda...")
+    except:
+        pass
+
+
+def fail_interrupted_job(row):
+    update_job(row['id'], status='failed', outcome='interrupted')
+    try:
+        bot.send_message(row['chat_id'], "❌ Bot qayta ishga tushdi va so'rovingiz bajarilmadi. Havolani qayta yuboring.")
+    except:
+        pass
+
+
+def submit_job(user_id, platform, message, func, *args, job_id=None):
+    """Queue a download job and tell the user their queue position"""
+    if job_id is None:
+        job_id = record_job(user_id, platform, 'job', message, func, args)
+        if process_role == 'receiver':
+            # Receiver runs no scheduler: a worker process claims it from the jobs table
+            if job_id is None:
+                bot.reply_to(message, "❌ Yuklab olinmadi")
+            else:
+                notify_queue_position(job_id, message)
+            return
+    state = {'message': None, 'started': False}
+    state_lock = threading.Lock()
+
+    def delete_queue_message(queue_msg):
+        try:
+            bot.delete_message(message.chat.id, queue_msg.message_id)
+        except:
+            pass
+
+    def on_start():
+        with state_lock:
+            state['started'] = True
+            queue_msg = state['message']
+        if queue_msg:
+            delete_queue_message(queue_msg)
+
+    position = scheduler.submit(user_id, platform, func, *args, on_start=on_start, job_id=job_id)
+    if position > 0:
+        try:
+            queue_msg = bot.send_message(message.chat.id, f"🕒 Navbatdasiz: {position}-o'rin")
+        except:
+            return
+        with state_lock:
+            if not state['started']:
+                state['message'] = queue_msg
+                return
+        # Job already started while we were sending
+        delete_queue_message(queue_msg)
+
+
+def notify_queue_position(job_id, message):
+    """Receiver mode: queue position from the jobs table; the worker that claims the job deletes the message"""
+    counts = db_query(
+        "SELECT SUM(status = 'pending' AND id < ?) AS ahead, SUM(status IN ('claimed', 'running')) AS busy "
+        "FROM jobs WHERE status IN ('pending', 'claimed', 'running')", (job_id,)
+    )[0]
+    position = (counts['ahead'] or 0) + 1 - max(0, DOWNLOAD_WORKERS * WORKER_PROCESSES - (counts['busy'] or 0))
+    if position <= 0:
+        return
+    try:
+        queue_msg = bot.send_message(message.chat.id, f"🕒 Navbatdasiz: {position}-o'rin")
+    except:
+        return
+    with db_lock:
+        claimed = db_conn.execute("UPDATE jobs SET notice = ? WHERE id = ? AND status = 'pending' RETURNING id",
+                                  (queue_msg.message_id, job_id)).fetchone() is None
+        db_conn.commit()
+    if claimed:
+        # Job already claimed while we were sending
+        delete_notice(message.chat.id, queue_msg.message_id)
+
+
+def delete_notice(chat_id, message_id):
+    try:
+        bot.delete_message(chat_id, message_id)
+    except:
+        pass
+
+
+# Single-flight: one download per media key, other chats wait for its file_id
+inflight = {}  # key -> list of waiting (user_id, platform, message, func, args, wait_msg, job_id)
+inflight_lock = threading.Lock()
+inflight_stats = {'leaders': 0, 'coalesced': 0}
+
+
+def submit_download(user_id, platform, message, key, func, *args, job_id=None):
+    """Queue a download, merging it with an in-flight download of the same key"""
+    if job_id is None:
+        job_id = record_job(user_id, platform, 'download', message, func, args, key)
+        if process_role == 'receiver':
+            # Receiver runs no scheduler: cache and single-flight are handled by the worker process
+            if job_id is None:
+                bot.reply_to(message, "❌ Yuklab olinmadi")
+            else:
+                notify_queue_position(job_id, message)
+            return
+    if cache_valid(key):
+        # Served by file_id, no need to wait for a download slot
+        submit_job(user_id, 'cached', message, serve_cached, user_id, platform, message, key, func, *args, job_id=job_id)
+        return
+    with inflight_lock:
+        waiters = inflight.get(key)
+        if waiters is None:
+            inflight[key] = []
+            inflight_stats['leaders'] += 1
+        else:
+            inflight_stats['coalesced'] += 1
+            waiters.append([user_id, platform, message, func, args, None, job_id])
+    if waiters is None:
+        submit_job(user_id, platform, message, run_flight, key, func, *args, job_id=job_id)
+        return
+    # Same media is already being downloaded for another chat
+    try:
+        wait_msg = bot.send_message(message.chat.id, "⏳ Yuklanmoqda...")
+    except:
+        return
+    with inflight_lock:
+        if key in inflight and inflight[key] is waiters:
+            waiters[-1][5] = wait_msg
+            return
+    # Flight already finished - drop the wait message
+    try:
+        bot.delete_message(message.chat.id, wait_msg.message_id)
+    except:
+        pass
+
+
+def cached_slot_miss(key):
+    """True in the 'cached' slot when its entry expired or Telegram rejected the file_id.
+    The download func then returns and serve_cached re-queues it on its platform"""
+    job = current_job()
+    if job and job.get('cached_key') == key:
+        job['cache_miss'] = True
+        return True
+    return False
+
+
+def serve_cached(user_id, platform, message, key, func, *args):
+    """Run func in the 'cached' slot; on a cache miss re-queue it as a normal download"""
+    job = current_job()
+    if job is None:
+        func(*args)
+        return
+    job['cached_key'] = key
+    func(*args)
+    if job.get('cache_miss'):
+        print(f"♻️ Cache miss in cached slot for {key}, queueing download")
+        job['outcome'] = 'requeued'
+        # A worker keeps the row claimed - 'pending' would let claim_job dispatch it a second time
+        update_job(job['id'], status='claimed' if process_role == 'worker' else 'pending', stage='queued')
+        submit_download(user_id, platform, message, key, func, *args, job_id=job['id'])
+
+
+def run_flight(key, func, *args):
+    """Run leader download, then re-send its file_id to waiting chats"""
+    try:
+        func(*args)
+    finally:
+        with inflight_lock:
+            waiters = inflight.pop(key, [])
+        for user_id, platform, message, waiter_func, waiter_args, wait_msg, job_id in waiters:
+            if wait_msg:
                 try:
-                    for f in os.listdir(item):
-                        os.remove(os.path.join(item, f))
-                    os.rmdir(item)
+                    bot.delete_message(message.chat.id, wait_msg.message_id)
                 except:
                     pass
-    except:
-        pass
+            if cache_valid(key):
+                submit_job(user_id, 'cached', message, serve_cached, user_id, platform, message, key,
+                           waiter_func, *waiter_args, job_id=job_id)
+            else:
+                # Leader failed - don't start a retry storm
+                finish_job(job_id, 'failed')
+                try:
+                    bot.reply_to(message, "❌ Yuklab olinmadi")
+                except:
+                    pass
+
+
+# Admission control
+user_buckets = TTLCache(SESSION_MAX, max(60, USER_BURST * 60 / max(USER_RATE_PER_MIN, 0.01)))
+admission_lock = threading.Lock()
 
 
-# Platform detection
-def detect_platform(url):
-    """Detect which platform the URL belongs to"""
-    url_lower = url.lower()
-    if 'instagram.com' in url_lower or 'instagr.am' in url_lower:
-        return 'instagram'
-    elif 'tiktok.com' in url_lower:
-        return 'tiktok'
-    elif 'youtube.com' in url_lower or 'youtu.be' in url_lower:
-        return 'youtube'
+def load_admission_settings():
+    """Restore admin-tuned ceiling"""
+    admission['max_inflight'] = int(get_setting('max_inflight', MAX_INFLIGHT_JOBS))
+
+
+def admit(user_id, key=None):
+    """Admission check for a new job. Returns rejection text, or None if accepted.
+    Cached media (live file_id entry) skips the global ceiling - it costs no disk or CPU."""
+    if is_admin(user_id):
+        return None
+    cached = key is not None and cache_valid(key)
+    if not cached and admission['max_inflight'] > 0:
+        if process_role == 'receiver':
+            inflight_jobs = db_query("SELECT COUNT(*) AS n FROM jobs WHERE status IN ('pending', 'claimed', 'running')")[0]['n']
+        else:
+            job_stats = scheduler.stats()
+            inflight_jobs = job_stats['queued'] + sum(job_stats['running'].values())
+        if inflight_jobs >= admission['max_inflight']:
+            admission_stats['busy'] += 1
+            return "🚦 Bot hozir juda band. Birozdan keyin qayta urinib ko'ring."
+    with admission_lock:
+        bucket = user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(USER_RATE_PER_MIN / 60, USER_BURST)
+        # Re-put keeps active users' buckets from expiring
+        user_buckets.put(user_id, bucket)
+    wait = bucket.try_acquire()
+    if wait:
+        admission_stats['rate_limited'] += 1
+        return f"⏳ Juda ko'p so'rov. {wait:.0f} soniyadan keyin urinib ko'ring."
     return None
 
 
@@ -145,142 +1988,185 @@ Havola yuboring! 🚀
     bot.send_message(message.chat.id, welcome_text, parse_mode='HTML', reply_markup=markup)
 
 
+# Instagram fetcher
+def get_instagram_post(shortcode):
+    """Post metadata (typename, media URLs, caption), cached by shortcode"""
+    post = instagram_post_cache.get(shortcode)
+    if post is None:
+        with instagram_fetch_slots, stage('probe'):
+            item = lazy_import('instaloader').Post.from_shortcode(get_loader().context, shortcode)
+            if item.typename == 'GraphSidecar':
+                nodes = [(node.is_video, node.video_url if node.is_video else node.display_url) for node in item.get_sidecar_nodes()]
+            else:
+                nodes = [(item.is_video, item.video_url if item.is_video else item.url)]
+            post = {'typename': item.typename, 'nodes': nodes, 'caption': item.caption}
+        instagram_post_cache.put(shortcode, post)
+    return post
+
+
+def fetch_instagram_node(node_url, path=None):
+    """Stream one CDN item in chunks to path, or into memory if path is None (photos)"""
+    with instagram_fetch_slots:
+        response = get_loader().context.get_raw(node_url)
+        if path is None:
+            data = b"".join(response.iter_content(chunk_size=256 * 1024))
+            count_bytes('download', len(data))
+            return data
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                f.write(chunk)
+        count_bytes('download', os.path.getsize(path))
+        return path
+
+
+def fetch_instagram_media(post, job_dir):
+    """Fetch all items of a post in parallel. Videos are spooled to job_dir
+    (kept for MP3), photos stay in memory. Returns [(type, path or bytes)]"""
+    nodes = post['nodes']
+    
+    def fetch(index):
+        is_video, node_url = nodes[index]
+        if is_video:
+            return ('video', fetch_instagram_node(node_url, os.path.join(job_dir(), f"{index + 1:02d}.mp4")))
+        return ('photo', fetch_instagram_node(node_url))
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(len(nodes), INSTAGRAM_FETCH_WORKERS))) as pool:
+        return list(pool.map(fetch, range(len(nodes))))
+
+
 # Instagram download (original logic - WORKS!)
-def download_instagram(url, user_id, message):
-    """Download Instagram video/image"""
+def download_instagram(url, user_id, message, media=None):
+    """Download Instagram video/image (media: routed ID, saves resolving the URL again)"""
+    media = media or media_id(url)
     shortcode = None
     loading_msg = None
+    job_dir = None
+    key = cache_key(media)
     try:
-        # Extract shortcode
-        try:
-            shortcode = url.split("/")[-2]
-            if not shortcode:
-                shortcode = url.split("/")[-3]
-        except IndexError:
+        # Serve from file_id cache
+        entry = cache_get(key)
+        if entry:
+            first_video = next((item for item in entry['items'] if item['type'] in ('video', 'animation', 'document')), None)
+            markup = types.InlineKeyboardMarkup()
+            if first_video:
+                markup.row(
+                    types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}"),
+                    types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}")
+                )
+            else:
+                markup.add(types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}"))
+            if send_cached(key, message.chat.id, reply_markup=markup, entry=entry):
+                user_data[user_id] = {
+                    'file_id': first_video['file_id'] if first_video else None,
+                    'media_id': media,
+                    'platform': 'instagram',
+                    'caption': entry.get('caption')
+                }
+                increment_download_count(user_id, 'instagram')
+                return
+        if cached_slot_miss(key):
+            return
+        
+        # Shortcode from the canonical ID (unresolved share links have none)
+        shortcode = media.split(':', 1)[1]
+        if not re.fullmatch(r'[\w-]+', shortcode):
             bot.reply_to(message, "❌ Link noto'g'ri")
             return
         
         loading_msg = bot.send_message(message.chat.id, "⏳ Instagram yuklanmoqda...")
         
-        # Download post
-        post = instaloader.Post.from_shortcode(loader.context, shortcode)
+        # Scratch directory only if the post has videos (photos stay in memory)
+        dir_lock = threading.Lock()
         
-        # Check if it's a sidecar (carousel)
-        if post.typename == 'GraphSidecar':
-            # Download all carousel items
-            loader.download_post(post, target=shortcode)
-        else:
-            # Single post
-            loader.download_post(post, target=shortcode)
+        def video_dir():
+            nonlocal job_dir
+            with dir_lock:
+                if job_dir is None:
+                    job_dir = new_job_dir('instagram')
+            return job_dir
+        
+        post = get_instagram_post(shortcode)
+        try:
+            with stage('download'):
+                media_files = fetch_instagram_media(post, video_dir)
+        except Exception as e:
+            # Cached CDN URLs may have expired - refresh metadata once
+            print(f"♻️ Instagram fetch failed for {shortcode}: {e}")
+            instagram_post_cache.pop(shortcode)
+            post = get_instagram_post(shortcode)
+            with stage('download'):
+                media_files = fetch_instagram_media(post, video_dir)
         
         # Get caption
-        caption = post.caption if post.caption else "📸 Instagram"
+        caption = post['caption'] if post['caption'] else "📸 Instagram"
         if len(caption) > 1000:
             caption = caption[:997] + "..."
         
-        # Find all media files
-        video_files = []
-        photo_files = []
-        all_files = sorted(os.listdir(shortcode))  # Sort for correct order
+        video_files = [path for kind, path in media_files if kind == 'video']
+        print(f"📊 Found {len(video_files)} videos, {len(media_files) - len(video_files)} photos")  # Debug
         
-        for file in all_files:
-            file_path = os.path.join(shortcode, file)
-            if file.endswith(".mp4"):
-                video_files.append(file_path)
-            elif file.endswith((".jpg", ".png")):
-                photo_files.append(file_path)
-        
-        print(f"📊 Found {len(video_files)} videos, {len(photo_files)} photos")  # Debug
+        markup = types.InlineKeyboardMarkup()
+        btn_caption = types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}")
+        if video_files:
+            btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
+            markup.row(btn_audio, btn_caption)
+        else:
+            markup.add(btn_caption)
         
         # Send media
-        if video_files:
-            # Send first video with buttons
-            with open(video_files[0], "rb") as video:
-                markup = types.InlineKeyboardMarkup()
-                btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
-                btn_caption = types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}")
-                markup.row(btn_audio, btn_caption)
+        if not media_files:
+            bot.delete_message(message.chat.id, loading_msg.message_id)
+            bot.reply_to(message, "❌ Media topilmadi")
+            release_job_dir(job_dir, remove=True)
+            return
+        
+        with stage('upload'):
+            if len(media_files) == 1 and video_files:
+                # Single video with buttons
+                with open(video_files[0], "rb") as video:
+                    sent = bot.send_video(message.chat.id, video, reply_markup=markup)
+                sent_items = [sent_item(sent)]
+                cache_put(key, sent_items, caption=caption)
+            elif len(media_files) == 1:
+                # Single photo with caption
+                photo = media_files[0][1]
                 try:
-                    bot.send_video(message.chat.id, video, reply_markup=markup)
+                    sent = bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=markup)
+                    sent_items = [sent_item(sent, caption)]
                 except:
-                    video.seek(0)
-                    bot.send_video(message.chat.id, video, reply_markup=markup)
-            
-            # Send other videos if any
-            for video_path in video_files[1:]:
-                with open(video_path, "rb") as video:
-                    bot.send_video(message.chat.id, video)
-            
-            # Store for MP3 and caption
-            user_data[user_id] = {
-                'file_path': video_files[0],
-                'folder_path': shortcode,
-                'platform': 'instagram',
-                'caption': caption
-            }
-            
-        elif photo_files:
-            # Send all photos
-            if len(photo_files) == 1:
-                # Single photo with caption
-                with open(photo_files[0], "rb") as photo:
-                    markup = types.InlineKeyboardMarkup()
-                    btn_caption = types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}")
-                    markup.add(btn_caption)
-                    try:
-                        bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=markup)
-                    except:
-                        photo.seek(0)
-                        bot.send_photo(message.chat.id, photo, reply_markup=markup)
-                    
-                    # Store caption
-                    user_data[user_id] = {
-                        'folder_path': shortcode,
-                        'platform': 'instagram',
-                        'caption': caption
-                    }
+                    sent = bot.send_photo(message.chat.id, photo, reply_markup=markup)
+                    sent_items = [sent_item(sent)]
+                cache_put(key, sent_items, caption=caption)
             else:
-                # Multiple photos (carousel)
-                print(f"📸 Sending {len(photo_files)} photos...")
-                
-                # First photo with description button
-                with open(photo_files[0], "rb") as photo:
-                    markup = types.InlineKeyboardMarkup()
-                    btn_caption = types.InlineKeyboardButton("📝 Description", callback_data=f"show_caption_{user_id}")
-                    markup.add(btn_caption)
-                    bot.send_photo(message.chat.id, photo, caption=f"📸 1/{len(photo_files)}", reply_markup=markup)
-                
-                # Store caption
-                user_data[user_id] = {
-                    'folder_path': shortcode,
-                    'platform': 'instagram',
-                    'caption': caption
-                }
-                
-                # Send remaining photos
-                for i in range(1, len(photo_files)):
-                    with open(photo_files[i], "rb") as photo:
-                        bot.send_photo(message.chat.id, photo, caption=f"📸 {i+1}/{len(photo_files)}")
-                        print(f"  ✅ Sent photo {i+1}/{len(photo_files)}")
-            
+                # Carousel (photos and videos mixed) as albums of up to 10
+                print(f"📸 Sending {len(media_files)} items as media group...")
+                sent_items = send_media_groups(message.chat.id, [(kind, path, None) for kind, path in media_files])
+                bot.send_message(message.chat.id, media_group_text([item for item in sent_items if item]), reply_markup=markup)
+                cache_put(key, sent_items, caption=caption, group=True)
+        count_bytes('upload', sum(len(source) if isinstance(source, bytes) else os.path.getsize(source)
+                                  for kind, source in media_files))
+        
+        # Store for MP3 and caption
+        first_video = next((item for item in sent_items if item and item['type'] == 'video'), None)
+        user_data[user_id] = {
+            'file_path': video_files[0] if video_files else None,
+            'folder_path': job_dir if video_files else None,
+            'file_id': first_video['file_id'] if first_video else None,
+            'media_id': media,
+            'platform': 'instagram',
+            'caption': caption
+        }
+        
+        if not video_files:
             # Cleanup immediately for photos
-            try:
-                shutil.rmtree(shortcode, ignore_errors=True)
-            except:
-                pass
-        else:
-            bot.delete_message(message.chat.id, loading_msg.message_id)
-            bot.reply_to(message, "❌ Media topilmadi")
-            return
+            release_job_dir(job_dir, remove=True)
         
         # Delete loading message
         bot.delete_message(message.chat.id, loading_msg.message_id)
         
         # Increment counter
-        increment_download_count(user_id)
-        
-        # Cleanup all shortcode folders
-        cleanup_all_folders()
+        increment_download_count(user_id, 'instagram')
+        release_job_dir(job_dir)
     
     except Exception as e:
         if loading_msg:
@@ -291,48 +2177,62 @@ def download_instagram(url, user_id, message):
         bot.reply_to(message, "❌ Instagram yuklab olinmadi")
         
         # Cleanup on error
-        if shortcode and os.path.exists(shortcode):
-            try:
-                for f in os.listdir(shortcode):
-                    os.remove(os.path.join(shortcode, f))
-                os.rmdir(shortcode)
-            except:
-                pass
+        release_job_dir(job_dir, remove=True)
 
 
 # TikTok download
-def download_tiktok(url, user_id, message):
-    """Download TikTok video"""
+def download_tiktok(url, user_id, message, media=None):
+    """Download TikTok video (media: routed ID, saves resolving the URL again)"""
+    media = media or media_id(url)
     loading_msg = None
-    download_path = None
+    job_dir = None
+    key = cache_key(media)
     try:
-        loading_msg = bot.send_message(message.chat.id, "⏳ TikTok yuklanmoqda...")
-        download_path = f"tiktok_{user_id}.mp4"
+        markup = types.InlineKeyboardMarkup()
+        btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
+        markup.add(btn_audio)
         
-        ydl_opts = {
-            'format': 'best',
-            'outtmpl': download_path,
-            'quiet': True
-        }
+        # Serve from file_id cache
+        entry = send_cached(key, message.chat.id, reply_markup=markup)
+        if entry:
+            user_data[user_id] = {'file_id': entry['items'][0]['file_id'], 'media_id': media, 'platform': 'tiktok'}
+            increment_download_count(user_id, 'tiktok')
+            return
+        if cached_slot_miss(key):
+            return
+        
+        loading_msg = bot.send_message(message.chat.id, "⏳ TikTok yuklanmoqda...")
+        job_dir = new_job_dir('tiktok')
+        download_path = os.path.join(job_dir, "video.mp4")
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with stage('download'), ydl_pool.checkout('tiktok', outtmpl=download_path) as ydl, \
+                download_engine.transfer(ydl, 'tiktok'):
             ydl.download([url])
         
         if os.path.exists(download_path):
-            with open(download_path, 'rb') as video:
-                markup = types.InlineKeyboardMarkup()
-                btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
-                markup.add(btn_audio)
-                bot.send_video(message.chat.id, video, reply_markup=markup)
+            file_size = os.path.getsize(download_path)
+            count_bytes('download', file_size)
+            with stage('upload'), open(download_path, 'rb') as video:
+                sent = bot.send_video(message.chat.id, video, reply_markup=markup)
+            count_bytes('upload', file_size)
+            cache_put(key, [sent_item(sent)])
             
             # Store for MP3
-            user_data[user_id] = {'file_path': download_path, 'platform': 'tiktok'}
+            user_data[user_id] = {
+                'file_path': download_path,
+                'folder_path': job_dir,
+                'file_id': (sent_item(sent) or {}).get('file_id'),
+                'media_id': media,
+                'platform': 'tiktok'
+            }
             
             bot.delete_message(message.chat.id, loading_msg.message_id)
-            increment_download_count(user_id)
+            increment_download_count(user_id, 'tiktok')
+            release_job_dir(job_dir)
         else:
             bot.delete_message(message.chat.id, loading_msg.message_id)
             bot.reply_to(message, "❌ TikTok yuklab olinmadi")
+            release_job_dir(job_dir, remove=True)
     
     except Exception:
         if loading_msg:
@@ -341,83 +2241,304 @@ def download_tiktok(url, user_id, message):
             except:
                 pass
         bot.reply_to(message, "❌ TikTok yuklab olinmadi")
-        if download_path and os.path.exists(download_path):
-            os.remove(download_path)
+        release_job_dir(job_dir, remove=True)
 
 
 
 # YouTube quality selection
+def get_youtube_info(url):
+    """Probe YouTube video once; info dict is cached by video ID for all users"""
+    key = media_id(url)
+    info = youtube_info_get(key)
+    if info is None:
+        with stage('probe'), ydl_pool.checkout('probe') as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True)
+        # Drop the probe's own format choice so downloads select from 'formats' afresh
+        for field in YOUTUBE_SELECTION_FIELDS:
+            info.pop(field, None)
+        youtube_info_put(key, info)
+    return info
+
+
+def youtube_info_get(key):
+    """Cached probe info; worker processes also reuse probes made by other workers"""
+    info = youtube_info_cache.get(key)
+    if info is None and process_role == 'worker':
+        rows = db_query("SELECT data FROM probe_cache WHERE key = ? AND created >= ?",
+                        (key, time.time() - YT_INFO_CACHE_TTL))
+        if rows:
+            info = json.loads(rows[0]['data'])
+            youtube_info_cache.put(key, info)
+    return info
+
+
+def youtube_info_put(key, info):
+    youtube_info_cache.put(key, info)
+    if process_role == 'worker':
+        db_execute("INSERT OR REPLACE INTO probe_cache (key, data, created) VALUES (?, ?, ?)",
+                   (key, json.dumps(info, ensure_ascii=False), time.time()))
+
+
+def youtube_info_drop(key):
+    youtube_info_cache.pop(key)
+    if process_role == 'worker':
+        db_execute("DELETE FROM probe_cache WHERE key = ?", (key,))
+
+
+def selected_format_ids(info):
+    """Format IDs yt-dlp will fetch for a processed info dict"""
+    return [f['format_id'] for f in info.get('requested_formats') or [info]]
+
+
+def estimate_size(f, duration):
+    """Estimated size in bytes from filesize, filesize_approx or bitrate x duration"""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+
+def mp3_size(duration):
+    """Estimated MP3 size in bytes (MP3_BITRATE x duration)"""
+    return int(MP3_BITRATE * 1000 / 8 * duration) if duration else None
+
+
+def best_audio_format(info):
+    """Best audio-only format (prefer m4a, which muxes into mp4 without transcoding)"""
+    audios = [f for f in info['formats'] if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if not audios:
+        return None
+    return max(audios, key=lambda f: (f.get('ext') == 'm4a', f.get('abr') or f.get('tbr') or 0))
+
+
+def mp4_compatible(codec, allowed):
+    """True if codec name (avc1.64001F, mp4a.40.2, ...) can be stream-copied into mp4"""
+    return bool(codec) and codec.lower().startswith(allowed)
+
+
 def get_youtube_formats(url):
-    """Get available formats for YouTube video"""
+    """Get available formats for YouTube video.
+    Per height prefers a pair within the upload limit, then H.264 + AAC (remux only), then the smallest.
+    Returns ({quality: {'format': spec, 'size': bytes, 'remux': bool}}, title, mp3_size)"""
     try:
-        ydl_opts = {'quiet': True, 'no_warnings': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = {}
-            for f in info['formats']:
-                # Get formats with both video and audio, or at least video
-                if f.get('vcodec') != 'none':
-                    height = f.get('height')
-                    if height and height >= 144:
-                        quality = f"{height}p"
-                        if quality not in formats:
-                            formats[quality] = f['format_id']
-            return formats, info.get('title', 'video')
+        info = get_youtube_info(url)
+        duration = info.get('duration')
+        audio = best_audio_format(info)
+        audio_size = estimate_size(audio, duration) if audio else None
+        formats = {}
+        for f in info['formats']:
+            # Get formats with both video and audio, or at least video
+            if f.get('vcodec') != 'none':
+                height = f.get('height')
+                if height and height >= 144:
+                    quality = f"{height}p"
+                    if f.get('acodec') not in (None, 'none'):
+                        spec, size = f['format_id'], estimate_size(f, duration)
+                        acodec = f.get('acodec')
+                    elif audio:
+                        spec = f"{f['format_id']}+{audio['format_id']}"
+                        video_size = estimate_size(f, duration)
+                        size = video_size + (audio_size or 0) if video_size else None
+                        acodec = audio.get('acodec')
+                    else:
+                        continue
+                    remux = mp4_compatible(f.get('vcodec'), MP4_VIDEO_CODECS) and mp4_compatible(acodec, MP4_AUDIO_CODECS)
+                    # Per quality: a pair that fits the upload limit, then remuxable, then the smallest
+                    candidate = {'format': spec, 'size': size, 'remux': remux}
+                    current = formats.get(quality)
+                    if current is None or format_rank(candidate) > format_rank(current):
+                        formats[quality] = candidate
+        return formats, info.get('title', 'video'), mp3_size(duration)
     except:
-        return None, None
+        return None, None, None
+
+
+def format_rank(entry):
+    """Sort key for candidate pairs of one height (unknown size ranks below known sizes)"""
+    return fits_upload_limit(entry['size']), entry['remux'], -(entry['size'] or float('inf'))
+
+
+def fits_upload_limit(size):
+    """True if estimated size is unknown or deliverable via Telegram"""
+    return not size or size <= TELEGRAM_UPLOAD_LIMIT
+
+
+def youtube_format_entry(formats, quality):
+    """Format entry for quality, downgraded to the best deliverable one if too big"""
+    entry = formats.get(quality)
+    if isinstance(entry, str):
+        # Session saved before size estimates existed
+        entry = {'format': f"{entry}+bestaudio", 'size': None, 'remux': False}
+    if entry and fits_upload_limit(entry['size']):
+        return quality, entry
+    height = int(quality[:-1])
+    fitting = [(q, e) for q, e in formats.items()
+               if isinstance(e, dict) and int(q[:-1]) < height and fits_upload_limit(e['size'])]
+    if not fitting:
+        return None, entry
+    return max(fitting, key=lambda item: int(item[0][:-1]))
+
+
+def size_label(size):
+    """Human readable size for buttons"""
+    if not size:
+        return ""
+    return f" · ~{size / (1024 * 1024):.0f}MB"
+
+
+def youtube_download(ydl, url):
+    """Download from cached probe info (no second extract_info), else by URL"""
+    key = media_id(url)
+    info = youtube_info_get(key)
+    if info is not None:
+        try:
+            selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+            if '+'.join(selected_format_ids(selected)) != selected.get('format_id'):
+                raise ValueError(f"format {selected.get('format_id')} would fetch {selected_format_ids(selected)}")
+            ydl.process_ie_result(copy.deepcopy(info), download=True)
+            return
+        except Exception as e:
+            # Stream URLs expired or info unusable - extract again
+            print(f"♻️ Cached YouTube info failed for {key}: {e}")
+            youtube_info_drop(key)
+    ydl.download([url])
+
+
+def show_youtube_qualities(url, user_id, message):
+    """Probe YouTube video and show quality selection keyboard"""
+    formats, title, mp3_estimate = get_youtube_formats(url)
+    if formats:
+        user_data[user_id] = {
+            'url': url,
+            'formats': formats
+        }
+        
+        markup = types.InlineKeyboardMarkup()
+        buttons = []
+        too_big = 0
+        for quality in sorted(formats.keys(), key=lambda x: int(x[:-1]), reverse=True):
+            size = formats[quality]['size']
+            if not fits_upload_limit(size):
+                # Can't be delivered - don't offer it
+                too_big += 1
+                continue
+            btn = types.InlineKeyboardButton(f"{quality}{size_label(size)}", callback_data=f"yt_quality_{quality}_{user_id}")
+            buttons.append(btn)
+        
+        btn_mp3 = types.InlineKeyboardButton(f"🎵 Faqat MP3{size_label(mp3_estimate)}", callback_data=f"yt_mp3only_{user_id}")
+        buttons.append(btn_mp3)
+        notice = ""
+        if too_big:
+            notice = f"\n⚠️ {too_big} ta sifat {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)}MB limitdan katta"
+        
+        for i in range(0, len(buttons), 2):
+            if i + 1 < len(buttons):
+                markup.row(buttons[i], buttons[i + 1])
+            else:
+                markup.row(buttons[i])
+        
+        bot.send_message(message.chat.id, f"🎬 <b>{title}</b>\n{notice}\nSifatni tanlang:", reply_markup=markup, parse_mode='HTML')
+        mark_outcome('ok')
+    else:
+        bot.reply_to(message, "❌ YouTube yuklab olinmadi")
+
+
+def youtube_session_formats(user_id, url):
+    """Keep quality buttons working after a download replaces the session"""
+    session = user_data.get(user_id)
+    if session is not None and session.get('url') == url:
+        return session.get('formats')
+    return None
 
 
 # YouTube download
 def download_youtube(url, user_id, message, format_id=None):
     """Download YouTube video"""
     loading_msg = None
-    download_path = None
+    job_dir = None
+    key = cache_key(media_id(url), format_id or 'best')
     try:
+        markup = types.InlineKeyboardMarkup()
+        btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
+        markup.add(btn_audio)
+        
+        # Serve from file_id cache
+        entry = send_cached(key, message.chat.id, reply_markup=markup)
+        if entry:
+            user_data[user_id] = {
+                'file_id': entry['items'][0]['file_id'],
+                'url': url,
+                'formats': youtube_session_formats(user_id, url),
+                'media_id': media_id(url),
+                'platform': 'youtube'
+            }
+            increment_download_count(user_id, 'youtube')
+            return
+        if cached_slot_miss(key):
+            return
+        
         loading_msg = bot.send_message(message.chat.id, "⏳ YouTube yuklanmoqda...")
-        download_path = f"youtube_{user_id}.mp4"
+        job_dir = new_job_dir('youtube')
+        download_path = os.path.join(job_dir, "video.mp4")
         
+        limit = TELEGRAM_UPLOAD_LIMIT
         if format_id:
-            ydl_opts = {
-                'format': f'{format_id}+bestaudio/best[ext=m4a]/best',
-                'outtmpl': download_path,
-                'quiet': True,
-                'no_warnings': True,
-                'merge_output_format': 'mp4',
-                'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': 'mp4'}]
-            }
+            video_format = f'{format_id}/best[ext=mp4][filesize<?{limit}]/best[filesize<?{limit}]'
         else:
-            ydl_opts = {
-                'format': 'bestvideo[ext=mp4][height<=1080]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-                'outtmpl': download_path,
-                'quiet': True,
-                'no_warnings': True,
-                'merge_output_format': 'mp4'
-            }
+            video_format = (f'bestvideo[vcodec^=avc1][height<=1080][filesize<?{limit}]+bestaudio[ext=m4a]/'
+                            f'best[ext=mp4][filesize<?{limit}]/best')
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        with stage('download'), ydl_pool.checkout('youtube', format=video_format, outtmpl=download_path) as ydl, \
+                download_engine.transfer(ydl, 'youtube'):
+            youtube_download(ydl, url)
         
         if os.path.exists(download_path):
+            count_bytes('download', os.path.getsize(download_path))
+            started = time.monotonic()
+            with stage('postprocess'):
+                mode = ensure_mp4_video(download_path, job_dir)
+            elapsed = time.monotonic() - started
+            video_stats[mode][0] += 1
+            video_stats[mode][1] += elapsed
+            print(f"⏱ YouTube {mode} ({format_id or 'best'}): {elapsed:.2f}s")
             file_size = os.path.getsize(download_path)
-            markup = types.InlineKeyboardMarkup()
-            btn_audio = types.InlineKeyboardButton("🎵 MP3 yuklab olish", callback_data=f"extract_audio_{user_id}")
-            markup.add(btn_audio)
             
-            with open(download_path, 'rb') as video:
+            if file_size > TELEGRAM_UPLOAD_LIMIT:
+                # Estimate was missing or wrong
+                bot.delete_message(message.chat.id, loading_msg.message_id)
+                bot.reply_to(message, f"❌ Video juda katta ({file_size/(1024*1024):.1f}MB)")
+                release_job_dir(job_dir, remove=True)
+                return
+            
+            with stage('upload'), open(download_path, 'rb') as video:
                 if file_size > 50 * 1024 * 1024:
                     # Send as document if >50MB
-                    bot.send_document(message.chat.id, video, caption=f"📹 YouTube ({file_size/(1024*1024):.1f}MB)", reply_markup=markup)
+                    doc_caption = f"📹 YouTube ({file_size/(1024*1024):.1f}MB)"
+                    sent = bot.send_document(message.chat.id, video, caption=doc_caption, reply_markup=markup)
+                    cache_put(key, [sent_item(sent, doc_caption)])
                 else:
-                    bot.send_video(message.chat.id, video, reply_markup=markup)
+                    sent = bot.send_video(message.chat.id, video, reply_markup=markup)
+                    cache_put(key, [sent_item(sent)])
+            count_bytes('upload', file_size)
             
             # Store for MP3
-            user_data[user_id] = {'file_path': download_path, 'platform': 'youtube'}
+            user_data[user_id] = {
+                'file_path': download_path,
+                'folder_path': job_dir,
+                'file_id': (sent_item(sent) or {}).get('file_id'),
+                'url': url,
+                'formats': youtube_session_formats(user_id, url),
+                'media_id': media_id(url),
+                'platform': 'youtube'
+            }
             
             bot.delete_message(message.chat.id, loading_msg.message_id)
-            increment_download_count(user_id)
+            increment_download_count(user_id, 'youtube')
+            release_job_dir(job_dir)
         else:
             bot.delete_message(message.chat.id, loading_msg.message_id)
             bot.reply_to(message, "❌ YouTube yuklab olinmadi")
+            release_job_dir(job_dir, remove=True)
     
     except Exception:
         if loading_msg:
@@ -426,20 +2547,186 @@ def download_youtube(url, user_id, message, format_id=None):
             except:
                 pass
         bot.reply_to(message, "❌ YouTube yuklab olinmadi")
-        if download_path and os.path.exists(download_path):
-            os.remove(download_path)
+        release_job_dir(job_dir, remove=True)
+
+
+# YouTube MP3 only
+def download_youtube_mp3(url, user_id, message):
+    """Download YouTube audio as MP3"""
+    mp3_key = cache_key(media_id(url), 'mp3')
+    if send_cached(mp3_key, message.chat.id) or cached_slot_miss(mp3_key):
+        return
+    
+    try:
+        size = mp3_size(get_youtube_info(url).get('duration'))
+    except Exception:
+        # Probe failed - let the download report it
+        size = None
+    if not fits_upload_limit(size):
+        bot.send_message(message.chat.id, f"❌ MP3 juda katta (~{size / (1024 * 1024):.0f}MB). "
+                         f"Telegram limiti: {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)}MB")
+        return
+    
+    loading_msg = bot.send_message(message.chat.id, "⏳ MP3 yuklanmoqda...")
+    job_dir = new_job_dir('ytaudio')
+    audio_path = os.path.join(job_dir, "audio")
+    
+    try:
+        # Includes yt-dlp's MP3 extraction postprocessor
+        with stage('download'), ydl_pool.checkout('mp3', outtmpl=audio_path) as ydl, \
+                download_engine.transfer(ydl, 'mp3'):
+            youtube_download(ydl, url)
+        
+        audio_file = f"{audio_path}.mp3"
+        if os.path.exists(audio_file):
+            file_size = os.path.getsize(audio_file)
+            count_bytes('download', file_size)
+            if file_size > TELEGRAM_UPLOAD_LIMIT:
+                # Estimate was missing or wrong
+                bot.delete_message(message.chat.id, loading_msg.message_id)
+                bot.reply_to(message, f"❌ MP3 juda katta ({file_size/(1024*1024):.1f}MB)")
+                return
+            with stage('upload'), open(audio_file, 'rb') as audio:
+                sent = bot.send_audio(message.chat.id, audio)
+            count_bytes('upload', file_size)
+            cache_put(mp3_key, [sent_item(sent)])
+        
+        bot.delete_message(message.chat.id, loading_msg.message_id)
+    except:
+        bot.delete_message(message.chat.id, loading_msg.message_id)
+        bot.send_message(message.chat.id, "❌ MP3 yuklab olinmadi")
+    finally:
+        release_job_dir(job_dir, remove=True)
+
+
+# Audio extraction (ffmpeg stream copy, MP3 encode only on request)
+def ffmpeg_binary():
+    """Path to ffmpeg (system or bundled imageio-ffmpeg)"""
+    path = shutil.which('ffmpeg')
+    if path:
+        return path
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return 'ffmpeg'
+
+
+def probe_codec(path, stream='a'):
+    """Return codec name of the first audio ('a') or video ('v') stream (None if missing)"""
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe:
+        result = subprocess.run(
+            [ffprobe, '-v', 'error', '-select_streams', f'{stream}:0',
+             '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', path],
+            capture_output=True, text=True, timeout=60
+        )
+        return result.stdout.strip() or None
+    # No ffprobe - parse "Audio: aac ..." / "Video: h264 ..." from ffmpeg banner
+    result = subprocess.run([ffmpeg_binary(), '-hide_banner', '-i', path], capture_output=True, text=True, timeout=60)
+    label = 'Audio' if stream == 'a' else 'Video'
+    match = re.search(rf'{label}: (\w+)', result.stderr)
+    return match.group(1) if match else None
+
+
+def probe_audio_codec(video_path):
+    """Return codec name of the first audio stream (None if no audio)"""
+    return probe_codec(video_path, 'a')
 
 
-# MP3 extraction (videodownloader.py style)
-def extract_audio(user_id, message):
-    """Extract MP3 from video using MoviePy (videodownloader.py algorithm)"""
+def convert_audio(video_path, out_dir, force_mp3=False):
+    """Extract audio track into out_dir. Remuxes AAC/MP3 losslessly, encodes MP3 otherwise.
+    Returns (audio_path, mode)"""
+    codec = probe_audio_codec(video_path)
+    if codec is None:
+        raise ValueError("Videoda audio yo'q")
+    if not force_mp3 and codec in AUDIO_COPY_CODECS:
+        audio_name = os.path.join(out_dir, f"audio.{AUDIO_COPY_CODECS[codec]}")
+        args = ['-vn', '-c:a', 'copy']
+        if codec == 'aac':
+            args += ['-movflags', '+faststart']
+        mode = 'copy'
+    else:
+        audio_name = os.path.join(out_dir, "audio.mp3")
+        args = ['-vn', '-c:a', 'libmp3lame', '-b:a', f'{MP3_BITRATE}k', '-threads', str(AUDIO_THREADS)]
+        mode = 'encode'
+    subprocess.run(
+        [ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y', '-i', video_path, *args, audio_name],
+        check=True, capture_output=True, timeout=AUDIO_TIMEOUT
+    )
+    return audio_name, mode
+
+
+# Video remux / transcode
+def nice_prefix():
+    """Command prefix running a child at reduced CPU priority (no preexec_fn - unsafe with threads)"""
+    nice = shutil.which('nice') if TRANSCODE_NICE else None
+    return [nice, '-n', str(TRANSCODE_NICE)] if nice else []
+
+
+def ensure_mp4_video(video_path, out_dir):
+    """Make video_path playable inline (H.264 + AAC/MP3 in mp4).
+    Merged streams are already stream-copied by yt-dlp; anything else is
+    re-encoded in place through the bounded transcode pool.
+    Returns 'remux' or 'transcode'"""
+    vcodec = probe_codec(video_path, 'v')
+    acodec = probe_codec(video_path, 'a')
+    copy_video = vcodec is None or mp4_compatible(vcodec, MP4_VIDEO_CODECS)
+    copy_audio = acodec is None or mp4_compatible(acodec, MP4_AUDIO_CODECS)
+    if copy_video and copy_audio:
+        return 'remux'
+    
+    if copy_video:
+        args = ['-c:v', 'copy']
+    else:
+        args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p']
+    args += ['-c:a', 'copy'] if copy_audio else ['-c:a', 'aac', '-b:a', '128k']
+    out_path = os.path.join(out_dir, "transcoded.mp4")
+    with transcode_slots:
+        subprocess.run(
+            [*nice_prefix(), ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y', '-i', video_path,
+             *args, '-threads', str(TRANSCODE_THREADS), '-movflags', '+faststart', out_path],
+            check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT
+        )
+    os.replace(out_path, video_path)
+    # Audio-only re-encode is cheap; only a video encode counts as a transcode
+    return 'remux' if copy_video else 'transcode'
+
+
+def extract_audio(user_id, message, force_mp3=False):
+    """Extract audio from downloaded video (lossless remux when possible)"""
+    job_dir = None
     try:
-        if user_id not in user_data:
+        session = user_data.get(user_id)
+        if session is None:
             bot.send_message(message.chat.id, "❌ Video topilmadi. Yangi havola yuboring.")
             return
         
-        video_path = user_data[user_id].get('file_path')
-        folder_path = user_data[user_id].get('folder_path')
+        video_path = session.get('file_path')
+        folder_path = session.get('folder_path')
+        file_id = session.get('file_id')
+        audio_key = None
+        if session.get('media_id'):
+            audio_key = cache_key(session.media_id, 'mp3' if force_mp3 else 'audio')
+            if send_cached(audio_key, message.chat.id):
+                return
+        
+        job_dir = new_job_dir('audio')
+        if (not video_path or not os.path.exists(video_path)) and file_id:
+            # Video was served from cache or evicted - fetch it back from Telegram
+            try:
+                with stage('download'):
+                    video_path = fetch_telegram_file(file_id, os.path.join(job_dir, "video.mp4"))
+            except telebot.apihelper.ApiTelegramException as e:
+                if 'too big' not in (e.description or ''):
+                    raise
+                # Bot API getFile is limited to 20MB
+                bot.send_message(message.chat.id, "❌ Video juda katta, MP3 uchun qayta yuklab bo'lmadi. Havolani qayta yuboring.")
+                return
+            count_bytes('download', os.path.getsize(video_path))
+            folder_path = None
+        elif folder_path:
+            touch_job_dir(folder_path)
         
         if not video_path or not os.path.exists(video_path):
             bot.send_message(message.chat.id, "❌ Video topilmadi. Yangi havola yuboring.")
@@ -447,33 +2734,40 @@ def extract_audio(user_id, message):
         
         bot.send_message(message.chat.id, "⏳ MP3 yuklanmoqda...")
         
-        # Extract audio using MoviePy (videodownloader.py style)
-        video = VideoFileClip(video_path)
-        audio = video.audio
-        audio_name = f"{uuid.uuid4()}.mp3"
-        audio.write_audiofile(audio_name, logger=None)
-        video.close()
+        started = time.monotonic()
+        with stage('postprocess'):
+            audio_name, mode = convert_audio(video_path, job_dir, force_mp3=force_mp3)
+        elapsed = time.monotonic() - started
+        audio_stats[mode][0] += 1
+        audio_stats[mode][1] += elapsed
+        print(f"⏱ Audio {mode} ({os.path.basename(audio_name)}): {elapsed:.2f}s")
         
-        # Send audio
-        with open(audio_name, "rb") as audio_file:
-            bot.send_audio(message.chat.id, audio_file)
+        # Offer explicit MP3 if we sent the original codec
+        markup = None
+        if mode == 'copy' and not audio_name.endswith('.mp3'):
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("🎵 MP3 formatda", callback_data=f"extract_mp3_{user_id}"))
         
-        # Cleanup audio file
-        os.remove(audio_name)
+        # Send audio
+        with stage('upload'), open(audio_name, "rb") as audio_file:
+            sent = bot.send_audio(message.chat.id, audio_file, reply_markup=markup)
+        count_bytes('upload', os.path.getsize(audio_name))
+        if audio_key:
+            cache_put(audio_key, [sent_item(sent)])
         
-        # Cleanup folder (videodownloader.py style - finally block)
-        if folder_path and os.path.exists(folder_path):
+        # Cleanup folder (keep video if user may still ask for MP3)
+        if folder_path and os.path.exists(folder_path) and markup is None:
             shutil.rmtree(folder_path, ignore_errors=True)
             print(f"✅ Cleaned up folder: {folder_path}")
         
-        # Cleanup all remaining folders
-        cleanup_all_folders()
-        
     except Exception as e:
         bot.reply_to(message, f"❌ MP3 xatosi: {str(e)}")
         print(f"❌ MP3 error: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        # Audio file (and fetched video) are only needed for this job
+        release_job_dir(job_dir, remove=True)
 
 
 # Callback handler
@@ -486,21 +2780,47 @@ def callback_handler(call):
         # Admin panel callbacks
         if call.data == "admin_users_list":
             if is_admin(user_id):
-                show_all_users(call.message)
+                send_users_page(call.message.chat.id)
+            return
+        
+        if call.data.startswith(("admin_users_next_", "admin_users_prev_")):
+            if is_admin(user_id):
+                cursor = int(call.data.rsplit("_", 1)[1])
+                if call.data.startswith("admin_users_next_"):
+                    send_users_page(call.message.chat.id, after=cursor, message_id=call.message.message_id)
+                else:
+                    send_users_page(call.message.chat.id, before=cursor, message_id=call.message.message_id)
+            return
+        
+        if call.data == "admin_export":
+            if is_admin(user_id):
+                bot.send_message(call.message.chat.id, EXPORT_USAGE)
+                start_export(call.message.chat.id, 'jsonl', {})
             return
         
         if call.data == "admin_broadcast":
             if is_admin(user_id):
                 bot.send_message(call.message.chat.id, "Barcha foydalanuvchilarga yubormoqchi bo'lgan xabaringizni yuboring:")
                 bot.register_next_step_handler(call.message, send_broadcast)
+                set_setting('broadcast_prompt', call.message.chat.id)
             return
         
+        if call.data.startswith(("extract_audio_", "extract_mp3_", "yt_quality_", "yt_mp3only_")):
+            rejection = admit(user_id)
+            if rejection:
+                bot.send_message(call.message.chat.id, rejection)
+                return
+        
         if call.data.startswith("extract_audio_"):
-            extract_audio(user_id, call.message)
+            submit_job(user_id, 'audio', call.message, extract_audio, user_id, call.message)
+        
+        elif call.data.startswith("extract_mp3_"):
+            submit_job(user_id, 'audio', call.message, extract_audio, user_id, call.message, True)
         
         elif call.data.startswith("show_caption_"):
-            if user_id in user_data:
-                caption = user_data[user_id].get('caption', 'Caption topilmadi')
+            session = user_data.get(user_id)
+            if session is not None:
+                caption = session.get('caption', 'Caption topilmadi')
                 bot.send_message(call.message.chat.id, f"📝 <b>Description:</b>\n\n{caption}", parse_mode='HTML')
             else:
                 bot.send_message(call.message.chat.id, "❌ Caption topilmadi")
@@ -513,14 +2833,23 @@ def callback_handler(call):
             if stored_user_id != user_id:
                 return
             
-            if user_id not in user_data:
+            session = user_data.get(user_id)
+            if session is None or not session.get('formats'):
                 return
             
-            url = user_data[user_id].get('url')
-            formats = user_data[user_id].get('formats')
-            format_id = formats.get(quality)
+            url = session.url
+            chosen, entry = youtube_format_entry(session.formats, quality)
+            if chosen is None:
+                size = entry['size'] if entry else 0
+                bot.send_message(call.message.chat.id, f"❌ Video juda katta (~{size / (1024 * 1024):.0f}MB). "
+                                 f"Telegram limiti: {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)}MB")
+                return
+            if chosen != quality:
+                bot.send_message(call.message.chat.id, f"⚠️ {quality} juda katta, {chosen} yuborilmoqda")
+            format_id = entry['format']
             
-            download_youtube(url, user_id, call.message, format_id)
+            key = cache_key(media_id(url), format_id or 'best')
+            submit_download(user_id, 'youtube', call.message, key, download_youtube, url, user_id, call.message, format_id)
         
         elif call.data.startswith("yt_mp3only_"):
             stored_user_id = int(call.data.split("_")[2])
@@ -528,67 +2857,123 @@ def callback_handler(call):
             if stored_user_id != user_id:
                 return
             
-            if user_id not in user_data:
+            session = user_data.get(user_id)
+            if session is None or not session.get('url'):
                 return
             
-            url = user_data[user_id].get('url')
-            loading_msg = bot.send_message(call.message.chat.id, "⏳ MP3 yuklanmoqda...")
-            audio_path = f"yt_audio_{user_id}"
-            
-            try:
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                    'outtmpl': audio_path,
-                    'quiet': True
-                }
-                
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-                
-                audio_file = f"{audio_path}.mp3"
-                if os.path.exists(audio_file):
-                    with open(audio_file, 'rb') as audio:
-                        bot.send_audio(call.message.chat.id, audio)
-                    os.remove(audio_file)
-                
-                bot.delete_message(call.message.chat.id, loading_msg.message_id)
-            except:
-                bot.delete_message(call.message.chat.id, loading_msg.message_id)
-                bot.send_message(call.message.chat.id, "❌ MP3 yuklab olinmadi")
+            url = session.url
+            key = cache_key(media_id(url), 'mp3')
+            submit_download(user_id, 'youtube', call.message, key, download_youtube_mp3, url, user_id, call.message)
     except:
         pass
 
 
 # Admin Panel
+def stats_snapshot():
+    """Live counters of this process"""
+    job_stats = scheduler.stats()
+    return {
+        'queued': job_stats['queued'],
+        'running': sum(job_stats['running'].values()),
+        'scratch': dict(scratch_stats),
+        'inflight': dict(inflight_stats),
+        'file_cache': dict(file_cache_stats),
+        'probe': {'entries': len(youtube_info_cache), 'hits': youtube_info_cache.hits, 'misses': youtube_info_cache.misses},
+        'ydl_pool': {'idle': len(ydl_pool), 'reused': ydl_pool.reused, 'created': ydl_pool.created},
+        'audio': {mode: list(values) for mode, values in audio_stats.items()},
+        'video': {mode: list(values) for mode, values in video_stats.items()},
+        'stages': metrics.recent_samples(),
+        'hosts': download_engine.stats(),
+    }
+
+
+def merge_stats(snapshots):
+    """Sum per-process snapshots (stage samples pooled, host throughput averaged)"""
+    total = {'stages': {}, 'hosts': {}}
+    hosts = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if name == 'stages':
+                for stage_name, samples in value.items():
+                    total['stages'].setdefault(stage_name, []).extend(samples)
+            elif name == 'hosts':
+                for host, measured in value.items():
+                    hosts.setdefault(host, []).append(measured)
+            elif name in ('audio', 'video'):
+                modes = total.setdefault(name, {})
+                for mode, (jobs, seconds) in value.items():
+                    previous = modes.get(mode, [0, 0.0])
+                    modes[mode] = [previous[0] + jobs, previous[1] + seconds]
+            elif isinstance(value, dict):
+                counts = total.setdefault(name, {})
+                for key, count in value.items():
+                    counts[key] = counts.get(key, 0) + count
+            else:
+                total[name] = total.get(name, 0) + value
+    for host, measured in hosts.items():
+        total['hosts'][host] = (sum(rate for rate, _ in measured) / len(measured), max(f for _, f in measured))
+    return total
+
+
+def admin_stats():
+    """Counters for the admin panel; in receiver mode summed over the live worker processes"""
+    snapshot = stats_snapshot()
+    if process_role != 'receiver':
+        return snapshot
+    rows = db_query("SELECT data FROM worker_stats WHERE updated >= ?", (time.time() - 3 * WORKER_STATS_INTERVAL,))
+    return merge_stats([snapshot] + [json.loads(row['data']) for row in rows])
+
+
+def mode_avg(modes, mode):
+    """Average audio/video processing time for mode"""
+    jobs, total = modes[mode]
+    return total / jobs if jobs else 0
+
+
+def stage_summary(stages):
+    """p50 / p95 per job stage for the admin panel"""
+    rows = []
+    for name in ('queue', 'probe', 'download', 'postprocess', 'upload', 'cleanup'):
+        result = sample_percentiles(stages.get(name, ()))
+        if result:
+            rows.append(f"{name}: {result[0]:.2f}s / {result[1]:.2f}s")
+    if not rows:
+        return "└ —"
+    return "\n".join(("└ " if i == len(rows) - 1 else "├ ") + row for i, row in enumerate(rows))
+
+
+def throughput_summary(hosts):
+    """Measured throughput and fragment concurrency per host for the admin panel"""
+    rows = [f"{host}: {rate:.1f} MB/s, {fragments}x" for host, (rate, fragments) in hosts.items()]
+    if not rows:
+        return "└ —"
+    return "\n".join(("└ " if i == len(rows) - 1 else "├ ") + row for i, row in enumerate(rows))
+
+
 def show_admin_panel(message):
     """Show admin panel"""
     if not is_admin(message.from_user.id):
         bot.reply_to(message, "❌ Sizda admin huquqi yo'q!")
         return
     
-    db = load_users_db()
-    total_users = len(db)
-    total_downloads = sum(user.get('total_downloads', 0) for user in db.values())
+    flush_users_db()
+    # Incrementally maintained aggregates - a handful of rows, independent of user count
+    counters = {row['name']: row['value'] for row in db_query("SELECT name, value FROM counters")}
+    total_users = counters.get('users', 0)
+    total_downloads = counters.get('downloads', 0)
+    blocked_users = counters.get('blocked', 0)
     
-    now = datetime.now()
-    active_today = 0
-    active_week = 0
-    
-    for user_info in db.values():
-        try:
-            last_seen = datetime.fromisoformat(user_info.get('last_seen', ''))
-            days_diff = (now - last_seen).days
-            if days_diff == 0:
-                active_today += 1
-            if days_diff <= 7:
-                active_week += 1
-        except:
-            pass
+    today = datetime.now().date()
+    active_days = {row['day']: row['users'] for row in db_query(
+        "SELECT day, users FROM active_days WHERE day >= ?", ((today - timedelta(days=6)).isoformat(),)
+    )}
+    active_today = active_days.get(today.isoformat(), 0)
+    active_week = sum(active_days.values())
+    unfinished_jobs = db_query("SELECT COUNT(*) AS n FROM jobs WHERE status IN ('pending', 'claimed', 'running')")[0]['n']
+    processes_line = f"├ Jarayonlar: {supervisor.alive()} / {WORKER_PROCESSES} ({supervisor.restarts} qayta ishga tushdi)\n" if supervisor else ""
+    stats = admin_stats()
+    # Worker processes add entries the receiver hasn't loaded
+    file_cache_entries = db_query("SELECT COUNT(*) AS n FROM file_cache")[0]['n'] if WORKER_PROCESSES > 0 else len(file_cache)
     
     admin_text = f"""
 👑 <b>Admin Panel</b>
@@ -596,25 +2981,106 @@ def show_admin_panel(message):
 👥 <b>Foydalanuvchilar:</b>
 ├ Jami: {total_users}
 ├ Bugun faol: {active_today}
-└ Hafta: {active_week}
+├ Hafta: {active_week}
+└ Bloklagan: {blocked_users}
 
 📥 <b>Yuklamalar:</b>
 ├ Jami: {total_downloads}
+├ Instagram: {counters.get('downloads:instagram', 0)} / TikTok: {counters.get('downloads:tiktok', 0)} / YouTube: {counters.get('downloads:youtube', 0)}
 └ O'rtacha: {total_downloads / total_users if total_users > 0 else 0:.1f} / user
 
 📁 <b>Faol sessiyalar:</b> {len(user_data)}
+💾 <b>Scratch:</b> {stats['scratch']['bytes'] / (1024 * 1024):.1f} / {SCRATCH_BUDGET / (1024 * 1024):.0f}MB ({stats['scratch']['dirs']} papka, {stats['scratch']['evicted']} tozalandi)
+
+⚙️ <b>Navbat:</b>
+├ Kutmoqda: {stats['queued']}
+├ Ishlamoqda: {stats['running']} / {DOWNLOAD_WORKERS * max(1, WORKER_PROCESSES)}
+├ Bazada tugallanmagan: {unfinished_jobs}
+{processes_line}├ Limit: {admission['max_inflight'] or '∞'} (/setlimit)
+├ Rad etildi: {admission_stats['busy']} band / {admission_stats['rate_limited']} tez-tez
+└ Birlashtirilgan: {stats['inflight']['coalesced']} ({stats['inflight']['leaders']} yuklash)
+
+⚡️ <b>Kesh (file_id):</b>
+├ Yozuvlar: {file_cache_entries}
+├ Hit: {stats['file_cache']['hits']} / Miss: {stats['file_cache']['misses']}
+├ Eskirgan: {stats['file_cache']['invalidated']}
+├ YouTube probe: {stats['probe']['entries']} ({stats['probe']['hits']} hit / {stats['probe']['misses']} miss)
+└ yt-dlp pool: {stats['ydl_pool']['idle']} bo'sh ({stats['ydl_pool']['reused']} qayta / {stats['ydl_pool']['created']} yangi)
+
+🎵 <b>Audio:</b>
+├ Copy: {stats['audio']['copy'][0]} ({mode_avg(stats['audio'], 'copy'):.2f}s o'rtacha)
+└ Encode: {stats['audio']['encode'][0]} ({mode_avg(stats['audio'], 'encode'):.2f}s o'rtacha)
+
+🎬 <b>Video:</b>
+├ Remux: {stats['video']['remux'][0]} ({mode_avg(stats['video'], 'remux'):.2f}s o'rtacha)
+└ Transcode: {stats['video']['transcode'][0]} ({mode_avg(stats['video'], 'transcode'):.2f}s o'rtacha)
+
+⏱ <b>Bosqichlar (p50 / p95):</b>
+{stage_summary(stats['stages'])}
+
+📶 <b>Yuklash tezligi:</b>
+{throughput_summary(stats['hosts'])}
 """
     
     markup = types.InlineKeyboardMarkup()
     btn_users = types.InlineKeyboardButton("👥 Barcha foydalanuvchilar", callback_data="admin_users_list")
     btn_broadcast = types.InlineKeyboardButton("📢 Broadcast", callback_data="admin_broadcast")
+    btn_export = types.InlineKeyboardButton("📤 Export", callback_data="admin_export")
     markup.row(btn_users)
-    markup.row(btn_broadcast)
+    markup.row(btn_broadcast, btn_export)
     
     bot.send_message(message.chat.id, admin_text, parse_mode='HTML', reply_markup=markup)
 
 
 # Admin commands
+USERS_PAGE_SIZE = 25
+
+
+def users_page(after=0, before=None):
+    """One keyset page of users ordered by user_id (primary key). Returns (text, markup) or (None, None)"""
+    columns = "user_id, username, first_name, total_downloads"
+    if before is not None:
+        rows = db_query(f"SELECT {columns} FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?",
+                        (before, USERS_PAGE_SIZE))[::-1]
+    else:
+        rows = db_query(f"SELECT {columns} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                        (after, USERS_PAGE_SIZE))
+    if not rows:
+        return None, None
+    
+    total_users = (db_query("SELECT value FROM counters WHERE name = 'users'") or [{'value': 0}])[0]['value']
+    users_text = f"👥 <b>Foydalanuvchilar</b> (jami {total_users}):\n\n"
+    for user_info in rows:
+        username = html.escape(user_info['username'] or 'N/A')
+        first_name = html.escape(user_info['first_name'] or 'N/A')
+        downloads = user_info['total_downloads']
+        users_text += f"<code>{user_info['user_id']}</code> @{username} ({first_name}) - {downloads} yuklamalar\n"
+    
+    first_id, last_id = rows[0]['user_id'], rows[-1]['user_id']
+    buttons = []
+    if db_query("SELECT 1 FROM users WHERE user_id < ? LIMIT 1", (first_id,)):
+        buttons.append(types.InlineKeyboardButton("⬅️ Oldingi", callback_data=f"admin_users_prev_{first_id}"))
+    if db_query("SELECT 1 FROM users WHERE user_id > ? LIMIT 1", (last_id,)):
+        buttons.append(types.InlineKeyboardButton("Keyingi ➡️", callback_data=f"admin_users_next_{last_id}"))
+    markup = None
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.row(*buttons)
+    return users_text, markup
+
+
+def send_users_page(chat_id, after=0, before=None, message_id=None):
+    """Send first page, or edit message_id in place when navigating"""
+    flush_users_db()
+    users_text, markup = users_page(after, before)
+    if users_text is None:
+        bot.send_message(chat_id, "Hozircha foydalanuvchilar yo'q")
+    elif message_id:
+        bot.edit_message_text(users_text, chat_id, message_id, reply_markup=markup, parse_mode='HTML')
+    else:
+        bot.send_message(chat_id, users_text, reply_markup=markup, parse_mode='HTML')
+
+
 @bot.message_handler(commands=['allusers'])
 def show_all_users(message):
     """Show all users (admin only)"""
@@ -622,22 +3088,7 @@ def show_all_users(message):
         bot.reply_to(message, "❌ Sizda admin huquqi yo'q!")
         return
     
-    db = load_users_db()
-    if not db:
-        bot.reply_to(message, "Hozircha foydalanuvchilar yo'q")
-        return
-    
-    users_text = "👥 <b>Barcha foydalanuvchilar:</b>\n\n"
-    for i, (user_id, user_info) in enumerate(list(db.items())[:50], 1):
-        username = user_info.get('username', 'N/A')
-        first_name = user_info.get('first_name', 'N/A')
-        downloads = user_info.get('total_downloads', 0)
-        users_text += f"{i}. @{username} ({first_name}) - {downloads} yuklamalar\n"
-    
-    if len(db) > 50:
-        users_text += f"\n... va yana {len(db) - 50} foydalanuvchi"
-    
-    bot.send_message(message.chat.id, users_text, parse_mode='HTML')
+    send_users_page(message.chat.id)
 
 
 @bot.message_handler(commands=['broadcast'])
@@ -649,30 +3100,124 @@ def broadcast_message(message):
     
     bot.reply_to(message, "Barcha foydalanuvchilarga yubormoqchi bo'lgan xabaringizni yuboring:")
     bot.register_next_step_handler(message, send_broadcast)
+    set_setting('broadcast_prompt', message.chat.id)
 
 
 def send_broadcast(message):
-    """Send broadcast message"""
-    db = load_users_db()
-    success = 0
-    failed = 0
-    
+    """Start broadcast of admin's message (any type) in the background"""
+    set_setting('broadcast_prompt', '')
+    flush_users_db()
+    total = db_query("SELECT COUNT(*) AS n FROM users WHERE blocked = 0")[0]['n']
     status_msg = bot.send_message(message.chat.id, "📢 Broadcast boshlandi...")
-    
-    for user_id in db.keys():
+    cursor = db_execute(
+        "INSERT INTO broadcasts (from_chat_id, message_id, status_chat_id, status_message_id, total, created) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (message.chat.id, message.message_id, status_msg.chat.id, status_msg.message_id, total, datetime.now().isoformat())
+    )
+    start_broadcast(cursor.lastrowid)
+
+
+# Broadcast engine
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+
+def broadcast_send(user_id, from_chat_id, message_id):
+    """Copy one message to user. Returns 'ok', 'blocked' or 'failed'"""
+    for attempt in range(5):
+        broadcast_bucket.acquire()
         try:
-            bot.send_message(int(user_id), message.text)
-            success += 1
-        except:
-            failed += 1
-    
-    bot.edit_message_text(
-        f"✅ Broadcast tugadi!\n\nMuvaffaqiyatli: {success}\nXato: {failed}",
-        message.chat.id,
-        status_msg.message_id
+            bot.copy_message(user_id, from_chat_id, message_id)
+            return 'ok'
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                print(f"⏸ Broadcast 429, retry after {retry_after}s")
+                broadcast_bucket.pause(retry_after)
+                continue
+            if e.error_code == 403:
+                # Bot blocked or user deactivated
+                return 'blocked'
+            return 'failed'
+        except Exception:
+            return 'failed'
+    return 'failed'
+
+
+def broadcast_progress_text(row, done):
+    """Status message text for broadcast row"""
+    return (
+        f"📢 Broadcast: {done}/{row['total']}\n\n"
+        f"Muvaffaqiyatli: {row['success']}\nXato: {row['failed']}\nBloklagan: {row['blocked']}"
     )
 
 
+def run_broadcast(broadcast_id):
+    """Send broadcast in batches, persisting cursor so it resumes after a crash"""
+    row = dict(db_query("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))[0])
+    last_edit = 0
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix='broadcast') as pool:
+        while True:
+            user_ids = [r['user_id'] for r in db_query(
+                "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+                (row['cursor'], BROADCAST_BATCH)
+            )]
+            if not user_ids:
+                break
+            results = list(pool.map(lambda uid: broadcast_send(uid, row['from_chat_id'], row['message_id']), user_ids))
+            blocked_ids = [(uid,) for uid, result in zip(user_ids, results) if result == 'blocked']
+            row['success'] += results.count('ok')
+            row['failed'] += results.count('failed')
+            row['blocked'] += len(blocked_ids)
+            row['cursor'] = user_ids[-1]
+            with db_lock:
+                db_conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", blocked_ids)
+                add_counters({'blocked': len(blocked_ids)})
+                db_conn.execute(
+                    "UPDATE broadcasts SET cursor = ?, success = ?, failed = ?, blocked = ? WHERE id = ?",
+                    (row['cursor'], row['success'], row['failed'], row['blocked'], broadcast_id)
+                )
+                db_conn.commit()
+            
+            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                done = row['success'] + row['failed'] + row['blocked']
+                try:
+                    bot.edit_message_text(broadcast_progress_text(row, done), row['status_chat_id'], row['status_message_id'])
+                except:
+                    pass
+    
+    db_execute("UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,))
+    try:
+        bot.edit_message_text(
+            f"✅ Broadcast tugadi!\n\nMuvaffaqiyatli: {row['success']}\nXato: {row['failed']}\nBloklagan: {row['blocked']}",
+            row['status_chat_id'],
+            row['status_message_id']
+        )
+    except:
+        pass
+
+
+def start_broadcast(broadcast_id):
+    """Run broadcast in a background thread"""
+    def runner():
+        try:
+            run_broadcast(broadcast_id)
+        except Exception as e:
+            print(f"❌ Broadcast {broadcast_id} error: {e}")
+    threading.Thread(target=runner, name=f"broadcast-{broadcast_id}", daemon=True).start()
+
+
+def resume_broadcasts():
+    """Continue broadcasts interrupted by a restart"""
+    for row in db_query("SELECT id FROM broadcasts WHERE status = 'running'"):
+        print(f"▶️ Resuming broadcast {row['id']}")
+        start_broadcast(row['id'])
+    # Admin was asked for the broadcast message before the restart
+    prompt_chat = get_setting('broadcast_prompt')
+    if prompt_chat:
+        bot.register_next_step_handler_by_chat_id(int(prompt_chat), send_broadcast)
+
+
 @bot.message_handler(commands=['stats'])
 def show_stats(message):
     """Show detailed statistics (admin only)"""
@@ -683,6 +3228,156 @@ def show_stats(message):
     show_admin_panel(message)
 
 
+@bot.message_handler(commands=['startup'])
+def show_startup_report(message):
+    """Show cold start timings (admin only)"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "❌ Sizda admin huquqi yo'q!")
+        return
+    
+    bot.send_message(message.chat.id, f"🚀 <b>Startup:</b>\n\n<pre>{startup_report()}</pre>", parse_mode='HTML')
+
+
+@bot.message_handler(commands=['setlimit'])
+def set_inflight_limit(message):
+    """Show or change the global in-flight job ceiling (admin only)"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "❌ Sizda admin huquqi yo'q!")
+        return
+    
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.reply_to(message, f"🚦 Hozirgi limit: {admission['max_inflight'] or '∞'}\n\nO'zgartirish: /setlimit 40 (0 = cheksiz)")
+        return
+    try:
+        limit = int(parts[1])
+        if limit < 0:
+            raise ValueError
+    except ValueError:
+        bot.reply_to(message, "❌ Musbat son kiriting: /setlimit 40")
+        return
+    admission['max_inflight'] = limit
+    set_setting('max_inflight', limit)
+    bot.reply_to(message, f"✅ Limit: {limit or '∞'}")
+
+
+# Users export
+EXPORT_CHUNK = 1000
+EXPORT_COLUMNS = ('user_id', 'username', 'first_name', 'first_seen', 'last_seen', 'total_downloads', 'blocked')
+EXPORT_USAGE = ("📤 /export [jsonl|csv] [days=N] [min=N] [blocked=0|1]\n\n"
+                "days - oxirgi N kunda faol, min - kamida N yuklama, blocked - bloklangan/bloklanmagan")
+export_slot = threading.Semaphore(1)
+
+
+def parse_export_args(text):
+    """'/export csv days=7 min=1' -> (format, filters). Raises ValueError"""
+    fmt, filters = 'jsonl', {}
+    for arg in text.split()[1:]:
+        name, _, value = arg.lower().partition('=')
+        if not value and name in ('jsonl', 'csv'):
+            fmt = name
+        elif name in ('days', 'min') and value.isdigit():
+            filters[name] = int(value)
+        elif name == 'blocked' and value in ('0', '1'):
+            filters[name] = int(value)
+        else:
+            raise ValueError(arg)
+    return fmt, filters
+
+
+def iter_export_rows(filters):
+    """Yield users in user_id order, EXPORT_CHUNK rows per query (keyset pagination)"""
+    where, params = ["user_id > ?"], []
+    if 'days' in filters:
+        where.append("last_seen >= ?")
+        params.append((datetime.now() - timedelta(days=filters['days'])).isoformat())
+    if 'min' in filters:
+        where.append("total_downloads >= ?")
+        params.append(filters['min'])
+    if 'blocked' in filters:
+        where.append("blocked = ?")
+        params.append(filters['blocked'])
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users WHERE {' AND '.join(where)} ORDER BY user_id LIMIT {EXPORT_CHUNK}"
+    last_id = 0
+    while True:
+        rows = db_query(sql, (last_id, *params))
+        yield from rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last_id = rows[-1]['user_id']
+
+
+def write_export(path, fmt, filters):
+    """Stream users into a gzip file. Returns number of rows"""
+    count = 0
+    with gzip.open(path, 'wt', compresslevel=6, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+        for row in iter_export_rows(filters):
+            if fmt == 'csv':
+                writer.writerow(tuple(row))
+            else:
+                f.write(json.dumps(dict(row), ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def run_export(chat_id, fmt, filters):
+    """Build export file and send it as a document"""
+    job_dir = new_job_dir('export')
+    try:
+        flush_users_db()
+        name = f"users-{datetime.now():%Y%m%d-%H%M%S}.{fmt}.gz"
+        path = os.path.join(job_dir, name)
+        started = time.time()
+        count = write_export(path, fmt, filters)
+        size = os.path.getsize(path)
+        if not fits_upload_limit(size):
+            bot.send_message(chat_id, f"❌ Eksport fayli juda katta ({size / (1024 * 1024):.0f}MB). Filtrlardan foydalaning.")
+            return
+        filter_text = ", ".join(f"{k}={v}" for k, v in filters.items()) or "yo'q"
+        caption = f"📤 {count} foydalanuvchi ({size / 1024:.0f}KB, {time.time() - started:.1f}s)\nFiltr: {filter_text}"
+        with open(path, 'rb') as f:
+            bot.send_document(chat_id, f, caption=caption, visible_file_name=name)
+        print(f"📤 Export: {count} users -> {name} ({size / 1024:.0f}KB)")
+    finally:
+        release_job_dir(job_dir, remove=True)
+
+
+def start_export(chat_id, fmt, filters):
+    """Run export in a background thread (one at a time)"""
+    if not export_slot.acquire(blocking=False):
+        bot.send_message(chat_id, "⏳ Eksport allaqachon ishlayapti")
+        return
+    
+    def runner():
+        try:
+            run_export(chat_id, fmt, filters)
+        except Exception as e:
+            print(f"❌ Export error: {e}")
+            bot.send_message(chat_id, f"❌ Eksport xatosi: {str(e)[:100]}")
+        finally:
+            export_slot.release()
+    bot.send_message(chat_id, "📤 Eksport tayyorlanmoqda...")
+    threading.Thread(target=runner, name='export', daemon=True).start()
+
+
+@bot.message_handler(commands=['export'])
+def export_users(message):
+    """Export users as gzip JSONL/CSV (admin only)"""
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "❌ Sizda admin huquqi yo'q!")
+        return
+    
+    try:
+        fmt, filters = parse_export_args(message.text)
+    except ValueError:
+        bot.reply_to(message, EXPORT_USAGE)
+        return
+    start_export(message.chat.id, fmt, filters)
+
+
 # Main message handler
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
@@ -700,42 +3395,397 @@ def handle_message(message):
         show_admin_panel(message)
         return
     
-    # Detect platform
-    platform = detect_platform(text)
+    # Route every supported link (canonical URL + ID)
+    routes = route_message(text)
+    if not routes:
+        bot.reply_to(message, "❌ Noma'lum havola. Instagram, TikTok yoki YouTube havolasini yuboring.")
+        return
     
-    if platform == 'instagram':
-        download_instagram(text, user_id, message)
-    elif platform == 'tiktok':
-        download_tiktok(text, user_id, message)
-    elif platform == 'youtube':
-        # Show quality selection
-        formats, title = get_youtube_formats(text)
-        if formats:
-            user_data[user_id] = {
-                'url': text,
-                'formats': formats
-            }
-            
-            markup = types.InlineKeyboardMarkup()
-            buttons = []
-            for quality in sorted(formats.keys(), key=lambda x: int(x[:-1]), reverse=True):
-                btn = types.InlineKeyboardButton(quality, callback_data=f"yt_quality_{quality}_{user_id}")
-                buttons.append(btn)
-            
-            btn_mp3 = types.InlineKeyboardButton("🎵 Faqat MP3", callback_data=f"yt_mp3only_{user_id}")
-            buttons.append(btn_mp3)
-            
-            for i in range(0, len(buttons), 2):
-                if i + 1 < len(buttons):
-                    markup.row(buttons[i], buttons[i + 1])
-                else:
-                    markup.row(buttons[i])
-            
-            bot.send_message(message.chat.id, f"🎬 <b>{title}</b>\n\nSifatni tanlang:", reply_markup=markup, parse_mode='HTML')
+    for route in routes[:MAX_LINKS_PER_MESSAGE]:
+        key = cache_key(route.media_id) if route.platform != 'youtube' else None
+        rejection = admit(user_id, key)
+        if rejection:
+            bot.reply_to(message, rejection)
+            return
+        
+        if route.platform == 'instagram':
+            submit_download(user_id, 'instagram', message, key, download_instagram, route.url, user_id, message,
+                            route.media_id)
+        elif route.platform == 'tiktok':
+            submit_download(user_id, 'tiktok', message, key, download_tiktok, route.url, user_id, message, route.media_id)
         else:
-            bot.reply_to(message, "❌ YouTube yuklab olinmadi")
-    else:
-        bot.reply_to(message, "❌ Noma'lum havola. Instagram, TikTok yoki YouTube havolasini yuboring.")
+            # Quality selection needs a probe - run it off the handler thread
+            submit_job(user_id, 'probe', message, show_youtube_qualities, route.url, user_id, message)
+
+
+# Worker processes
+def claim_job(worker):
+    """Atomically take the oldest pending job (SQLite serialises writers across processes).
+    Downloads are claimed by key: a key being downloaded by another worker is skipped, and
+    pending rows with the same key go to the same worker, where single-flight merges them.
+    Returns the claimed rows, leader first"""
+    now = time.time()
+    with db_lock:
+        row = db_conn.execute(
+            "UPDATE jobs SET status = 'claimed', worker = ?, updated = ? WHERE id = ("
+            "SELECT id FROM jobs AS j WHERE status = 'pending' AND (key IS NULL OR NOT EXISTS ("
+            "SELECT 1 FROM jobs WHERE key = j.key AND status IN ('claimed', 'running') AND worker != ?"
+            ")) ORDER BY id LIMIT 1) RETURNING *",
+            (worker, now, worker)
+        ).fetchone()
+        rows = [row] if row else []
+        if row and row['kind'] == 'download' and row['key']:
+            rows += sorted(db_conn.execute(
+                "UPDATE jobs SET status = 'claimed', worker = ?, updated = ? "
+                "WHERE status = 'pending' AND kind = 'download' AND key = ? RETURNING *",
+                (worker, now, row['key'])
+            ).fetchall(), key=lambda r: r['id'])
+        db_conn.commit()
+    return rows
+
+
+def recover_worker_jobs(worker):
+    """Jobs of a dead worker process go back to the queue (or fail after JOB_MAX_ATTEMPTS)"""
+    for row in db_query("SELECT * FROM jobs WHERE worker = ? AND status IN ('claimed', 'running')", (worker,)):
+        if row['status'] == 'claimed' or job_resumable(row):
+            update_job(row['id'], status='pending', worker=None)
+        else:
+            fail_interrupted_job(row)
+
+
+worker_stopping = threading.Event()
+
+
+def publish_stats_loop(index):
+    """Worker process: publish this process's counters for the receiver's admin panel"""
+    while not worker_stopping.is_set():
+        try:
+            db_execute("INSERT OR REPLACE INTO worker_stats (worker, data, updated) VALUES (?, ?, ?)",
+                       (index, json.dumps(stats_snapshot()), time.time()))
+        except Exception as e:
+            print(f"⚠️ Stats publish error: {e}")
+        worker_stopping.wait(WORKER_STATS_INTERVAL)
+
+
+def worker_main(index):
+    """Worker process: claims jobs from SQLite and runs them on the local JobScheduler"""
+    global process_role, SCRATCH_ROOT, SCRATCH_BUDGET
+    process_role = 'worker'
+    SCRATCH_ROOT = os.path.join(SCRATCH_ROOT, f"worker-{index}")  # each process owns its janitor
+    SCRATCH_BUDGET //= max(1, WORKER_PROCESSES)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: worker_stopping.set())
+    
+    init_db()
+    load_file_cache()
+    os.makedirs(SCRATCH_ROOT, exist_ok=True)
+    threading.Thread(target=janitor_loop, name='janitor', daemon=True).start()
+    scheduler.start()
+    if YDL_POOL_WARM:
+        threading.Thread(target=ydl_pool.warm, name='ydl-warm', daemon=True).start()
+    threading.Thread(target=publish_stats_loop, args=(index,), name='stats', daemon=True).start()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    pid = os.getpid()
+    print(f"👷 Worker {index} ready (pid {pid}, {DOWNLOAD_WORKERS} threads)")
+    
+    while not worker_stopping.is_set():
+        # Claim only what the local scheduler can start now - the rest stays claimable by other workers
+        job_stats = scheduler.stats()
+        if job_stats['queued'] + sum(job_stats['running'].values()) >= scheduler.workers:
+            worker_stopping.wait(WORKER_POLL_INTERVAL)
+            continue
+        rows = claim_job(pid)
+        if not rows:
+            worker_stopping.wait(WORKER_POLL_INTERVAL)
+            continue
+        for row in rows:
+            if row['notice']:
+                delete_notice(row['chat_id'], row['notice'])
+            if row['attempts']:
+                notify_resumed(row)
+            dispatch_job_row(row)
+    
+    # Graceful shutdown: let running jobs finish, hand back the rest
+    print(f"👷 Worker {index} stopping")
+    deadline = time.time() + WORKER_SHUTDOWN_TIMEOUT
+    while time.time() < deadline:
+        job_stats = scheduler.stats()
+        if not job_stats['queued'] and not sum(job_stats['running'].values()):
+            break
+        time.sleep(0.5)
+    recover_worker_jobs(pid)
+    flush_users_db()
+
+
+class WorkerSupervisor:
+    """Runs worker_main in N spawned processes, restarts crashed ones (with backoff)
+    and returns their unfinished jobs to the queue"""
+    
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}  # index -> Process
+        self.started = {}  # index -> spawn time
+        self.failures = {}  # index -> crashes in a row
+        self.restarts = 0
+        self.stopping = threading.Event()
+    
+    def _spawn(self, index):
+        process = self.context.Process(target=worker_main, args=(index,), name=f"worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.time()
+    
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        threading.Thread(target=self._watch, name='worker-supervisor', daemon=True).start()
+    
+    def _watch(self):
+        while not self.stopping.wait(1):
+            for index, process in list(self.processes.items()):
+                if process.is_alive() or self.stopping.is_set():
+                    continue
+                # Crashing right after start - back off instead of spinning
+                quick = time.time() - self.started[index] < 30
+                self.failures[index] = self.failures.get(index, 0) + 1 if quick else 0
+                delay = min(60, 2 ** self.failures[index]) if quick else 0
+                print(f"💥 Worker {index} (pid {process.pid}) exited with {process.exitcode}, "
+                      f"restarting in {delay}s")
+                recover_worker_jobs(process.pid)
+                if self.stopping.wait(delay):
+                    return
+                self.restarts += 1
+                self._spawn(index)
+    
+    def stop(self):
+        """SIGTERM workers, wait for running jobs, kill leftovers"""
+        self.stopping.set()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + WORKER_SHUTDOWN_TIMEOUT + 5
+        for process in self.processes.values():
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+                recover_worker_jobs(process.pid)
+    
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes.values())
+
+
+supervisor = None
+
+
+def stop_receiver(signum, frame):
+    """SIGTERM/SIGINT in receiver mode: stop workers gracefully, then exit"""
+    print("🛑 Stopping worker processes...")
+    if supervisor:
+        supervisor.stop()
+    raise SystemExit(0)
+
+
+def stop_process(signum, frame):
+    """SIGTERM in single-process mode: write buffered user updates, then exit (atexit doesn't run on a signal)"""
+    print("🛑 Stopping...")
+    flush_users_db()
+    raise SystemExit(0)
+
+
+# Metrics endpoint (Prometheus text format)
+def metrics_text():
+    """Stage metrics plus live gauges"""
+    job_stats = scheduler.stats()
+    gauges = {
+        'saverbot_jobs_queued': job_stats['queued'],
+        'saverbot_jobs_running': sum(job_stats['running'].values()),
+        'saverbot_sessions': len(user_data),
+        'saverbot_file_cache_entries': len(file_cache),
+        'saverbot_scratch_bytes': scratch_stats['bytes'],
+    }
+    lines = [metrics.render()]
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge\n{name} {value}\n")
+    hosts = download_engine.stats()
+    if hosts:
+        lines.append("# TYPE saverbot_host_throughput_bytes gauge\n")
+        lines += [f'saverbot_host_throughput_bytes{{host="{host}"}} {rate * 1024 * 1024:.0f}\n'
+                  for host, (rate, _) in hosts.items()]
+        lines.append("# TYPE saverbot_host_fragments gauge\n")
+        lines += [f'saverbot_host_fragments{{host="{host}"}} {fragments}\n' for host, (_, fragments) in hosts.items()]
+    return "".join(lines)
+
+
+def serve_metrics(handler):
+    """Write /metrics response on an HTTP request handler"""
+    if METRICS_TOKEN and not hmac.compare_digest(handler.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        handler.send_error(401)
+        return
+    body = metrics_text().encode()
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Standalone /metrics server for polling mode and worker processes"""
 
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        serve_metrics(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"📈 Metrics on :{port}/metrics")
+    return server
+
+
+# Webhook receiver
+webhook_queues = []
+webhook_stats = {'received': 0, 'rejected': 0}
+
+
+def update_chat_id(update):
+    """Chat (or user) ID of a raw update, used to keep per-chat ordering"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query', 'my_chat_member'):
+        obj = update.get(key)
+        if obj:
+            if key == 'callback_query':
+                obj = obj.get('message') or {'chat': obj.get('from', {})}
+            return (obj.get('chat') or obj.get('from') or {}).get('id', 0)
+    return 0
+
+
+def webhook_worker(updates):
+    """Process updates from one queue in arrival order"""
+    while True:
+        data = updates.get()
+        try:
+            bot.process_new_updates([types.Update.de_json(data)])
+        except Exception as e:
+            print(f"❌ Update {data.get('update_id')} error: {e}")
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts Telegram updates, acks immediately and queues them by chat"""
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            webhook_stats['rejected'] += 1
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Ack first - Telegram waits for the response before sending the next update
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        webhook_stats['received'] += 1
+        webhook_queues[update_chat_id(data) % len(webhook_queues)].put(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            # Public port: only when asked for (METRICS_PORT=PORT) and behind METRICS_TOKEN
+            if METRICS_PORT == PORT and METRICS_TOKEN:
+                serve_metrics(self)
+            else:
+                self.send_error(404)
+            return
+        # Health check for Railway
+        body = b"ok"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-bot.infinity_polling()
+
+def start_webhook_server(port=PORT):
+    """Start HTTP receiver and per-chat worker queues. Returns the server"""
+    for i in range(WEBHOOK_WORKERS):
+        updates = queue.Queue()
+        webhook_queues.append(updates)
+        threading.Thread(target=webhook_worker, args=(updates,), name=f"webhook-worker-{i}", daemon=True).start()
+    server = ThreadingHTTPServer(('0.0.0.0', port), WebhookHandler)
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    return server
+
+
+def run_webhook():
+    """Register webhook with Telegram and serve updates until interrupted"""
+    global WEBHOOK_SECRET
+    if not WEBHOOK_URL:
+        raise SystemExit("❌ BOT_MODE=webhook uchun WEBHOOK_URL kerak")
+    if not WEBHOOK_SECRET:
+        # Updates without Telegram's secret header are rejected, so there must always be one
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        print("🔑 WEBHOOK_SECRET not set, using a generated secret for this run")
+    server = start_webhook_server()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    print(f"🌐 Webhook listening on :{PORT}{WEBHOOK_PATH}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    phase_started = time.perf_counter()
+    if WORKER_PROCESSES > 0:
+        process_role = 'receiver'
+        SCRATCH_ROOT = os.path.join(SCRATCH_ROOT, 'receiver')
+    init_db()
+    load_file_cache()
+    load_admission_settings()
+    startup_timings['database'] = time.perf_counter() - phase_started
+    os.makedirs(SCRATCH_ROOT, exist_ok=True)
+    threading.Thread(target=janitor_loop, name='janitor', daemon=True).start()
+    if process_role != 'receiver':
+        # Receiver only records jobs; downloads run in the worker processes
+        scheduler.start()
+        if YDL_POOL_WARM:
+            threading.Thread(target=ydl_pool.warm, name='ydl-warm', daemon=True).start()
+    if METRICS_PORT and not (BOT_MODE == 'webhook' and METRICS_PORT == PORT):
+        start_metrics_server()
+    elif METRICS_PORT and not METRICS_TOKEN:
+        print("⚠️ /metrics on the public PORT needs METRICS_TOKEN - not served")
+    resume_broadcasts()
+    resume_jobs()
+    if WORKER_PROCESSES > 0:
+        supervisor = WorkerSupervisor(WORKER_PROCESSES)
+        supervisor.start()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop_receiver)
+        print(f"👷 {WORKER_PROCESSES} worker processes, this process only receives updates")
+    else:
+        signal.signal(signal.SIGTERM, stop_process)
+    startup_timings['total'] = time.perf_counter() - STARTUP_STARTED
+    print(f"🚀 Startup report:\n{startup_report()}")
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling()